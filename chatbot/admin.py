@@ -1,13 +1,75 @@
 from django.contrib import admin
-from django.utils.html import format_html
+from django.utils.html import escape, format_html
+from django.utils.safestring import mark_safe
 from django.urls import reverse
 from django.http import HttpResponseRedirect
 from django.contrib import messages
-from django.db.models import Count, Q
+from django.db.models import Avg, Count, Func, IntegerField, Max, Min, Q, Value
+from django.db.models.functions import Length, Substr
 from django.utils import timezone
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connection, connections
+from django.utils.functional import cached_property
 from datetime import datetime, timedelta
+from .exports import INLINE_EXPORT_LIMIT, Echo, write_messages_csv
 from .models import Message
-from .signals import conversation_ended
+from .signals import conversation_ended, recent_errors
+
+def _render_badge(color, label):
+    """Render a colored role badge"""
+    return format_html(
+        '<span style="background-color: {}; color: white; padding: 4px 8px; '
+        'border-radius: 12px; font-size: 12px; font-weight: bold;">{}</span>',
+        color, label
+    )
+
+_ROLE_COLORS = {
+    'user': '#667eea',
+    'assistant': '#10b981',
+}
+_DEFAULT_ROLE_COLOR = '#6b7280'
+
+# Only two roles exist, so their badges are rendered once at import time
+_ROLE_BADGES = {
+    role: _render_badge(color, role.title()) for role, color in _ROLE_COLORS.items()
+}
+
+_PREVIEW_OPEN = '<div style="max-width: 300px;">'
+_PREVIEW_CLOSE = '</div>'
+
+# (seconds per unit, unit name), largest first
+_TIME_AGO_UNITS = ((86400, 'day'), (3600, 'hour'), (60, 'minute'))
+
+# Smaller estimates are counted exactly: a count that fits on one page (or
+# under "Show all") makes the changelist fetch every row without a LIMIT, so
+# a stale estimate there could pull in the whole table
+ESTIMATED_COUNT_MIN = 10_000
+
+class FasterAdminPaginator(Paginator):
+    """Paginator that avoids COUNT(*) on unfiltered changelists"""
+    
+    @cached_property
+    def count(self):
+        """Use the planner's row estimate when no filters are applied (PostgreSQL only)"""
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where:
+            return super().count
+        db_connection = connections[self.object_list.db]
+        if db_connection.vendor != 'postgresql':
+            return super().count
+        
+        with db_connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                [query.model._meta.db_table]
+            )
+            row = cursor.fetchone()
+        
+        # reltuples is -1/0 until the table has been analyzed
+        if not row or row[0] < ESTIMATED_COUNT_MIN:
+            return super().count
+        return row[0]
 
 class MessageAdmin(admin.ModelAdmin):
     """Custom admin interface for Message model"""
@@ -25,7 +87,9 @@ class MessageAdmin(admin.ModelAdmin):
     readonly_fields = ['created_at', 'message_length', 'word_count']
     ordering = ['-created_at']
     list_per_page = 25
-    date_hierarchy = 'created_at'
+    paginator = FasterAdminPaginator
+    show_full_result_count = False
+    show_statistics_links = True
     
     fieldsets = (
         ('Message Information', {
@@ -37,83 +101,85 @@ class MessageAdmin(admin.ModelAdmin):
         }),
     )
     
-    actions = [
+    actions = (
         'export_messages', 
         'delete_old_messages', 
         'mark_as_important',
-        'generate_conversation_report'
-    ]
+        'generate_conversation_report',
+    )
     
     def role_badge(self, obj):
         """Display role as a colored badge"""
-        colors = {
-            'user': '#667eea',
-            'assistant': '#10b981'
-        }
-        color = colors.get(obj.role, '#6b7280')
-        return format_html(
-            '<span style="background-color: {}; color: white; padding: 4px 8px; '
-            'border-radius: 12px; font-size: 12px; font-weight: bold;">{}</span>',
-            color, obj.role.title()
-        )
+        badge = _ROLE_BADGES.get(obj.role)
+        if badge is None:
+            badge = _render_badge(_DEFAULT_ROLE_COLOR, obj.role.title())
+        return badge
     role_badge.short_description = 'Role'
     role_badge.admin_order_field = 'role'
     
     def content_preview(self, obj):
         """Show a preview of the message content"""
-        preview = obj.content[:100] + "..." if len(obj.content) > 100 else obj.content
-        return format_html('<div style="max-width: 300px;">{}</div>', preview)
+        content = getattr(obj, '_preview', None)
+        if content is None:
+            content = obj.content
+        preview = content[:100] + "..." if len(content) > 100 else content
+        return mark_safe(_PREVIEW_OPEN + escape(preview) + _PREVIEW_CLOSE)
     content_preview.short_description = 'Content Preview'
     
     def message_length(self, obj):
         """Display message length"""
-        return f"{len(obj.content)} characters"
+        length = getattr(obj, '_length', None)
+        if length is None:
+            length = len(obj.content)
+        return f"{length} characters"
     message_length.short_description = 'Length'
     
     def word_count(self, obj):
         """Calculate word count"""
-        return len(obj.content.split())
+        word_count = getattr(obj, '_word_count', None)
+        if word_count is None:
+            word_count = len(obj.content.split())
+        return word_count
     word_count.short_description = 'Words'
     
     def time_ago(self, obj):
         """Show how long ago the message was created"""
-        now = timezone.now()
-        diff = now - obj.created_at
+        seconds = int((timezone.now() - obj.created_at).total_seconds())
         
-        if diff.days > 0:
-            return f"{diff.days} day{'s' if diff.days != 1 else ''} ago"
-        elif diff.seconds > 3600:
-            hours = diff.seconds // 3600
-            return f"{hours} hour{'s' if hours != 1 else ''} ago"
-        elif diff.seconds > 60:
-            minutes = diff.seconds // 60
-            return f"{minutes} minute{'s' if minutes != 1 else ''} ago"
-        else:
-            return "Just now"
+        for threshold, unit in _TIME_AGO_UNITS:
+            if seconds >= threshold:
+                n = seconds // threshold
+                return f"{n} {unit}{'s' if n != 1 else ''} ago"
+        return "Just now"
     time_ago.short_description = 'Time Ago'
     time_ago.admin_order_field = 'created_at'
     
     def export_messages(self, request, queryset):
-        """Export selected messages to CSV"""
-        import csv
-        from django.http import HttpResponse
-        
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="messages_export.csv"'
-        
-        writer = csv.writer(response)
-        writer.writerow(['ID', 'Role', 'Content', 'Created At', 'Length'])
+        """Export selected messages to CSV, streamed row by row"""
+        from django.http import StreamingHttpResponse
         
-        for message in queryset:
-            writer.writerow([
-                message.id,
-                message.role,
-                message.content,
-                message.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                len(message.content)
-            ])
+        # Very large selections would hold a worker for the whole download
+        if queryset[INLINE_EXPORT_LIMIT:INLINE_EXPORT_LIMIT + 1].exists():
+            # The command can't replay an arbitrary selection, only the period it spans
+            span = queryset.aggregate(
+                since=Min('created_at'), until=Max('created_at'),
+                first_role=Min('role'), last_role=Max('role')
+            )
+            command = (
+                f"python manage.py export_messages <file> "
+                f"--since {span['since'].isoformat()} --until {span['until'].isoformat()}"
+            )
+            if span['first_role'] == span['last_role']:
+                command += f" --role {span['first_role']}"
+            messages.warning(
+                request,
+                f"More than {INLINE_EXPORT_LIMIT} messages selected; nothing was exported. "
+                f"Run '{command}' to export every message from the same period offline."
+            )
+            return None
         
-        messages.success(request, f"Exported {queryset.count()} messages to CSV")
+        response = StreamingHttpResponse(write_messages_csv(queryset, Echo()), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="messages_export.csv"'
         return response
     export_messages.short_description = "Export selected messages to CSV"
     
@@ -140,59 +206,75 @@ class MessageAdmin(admin.ModelAdmin):
         assistant_count = queryset.filter(role='assistant').count()
         
         # Calculate average message length
-        avg_length = queryset.aggregate(avg_length=Count('content'))['avg_length']
+        avg_length = queryset.aggregate(avg_length=Avg(Length('content')))['avg_length'] or 0
         
         report = f"""
         Conversation Report:
         - Total Messages: {queryset.count()}
         - User Messages: {user_count}
         - Assistant Messages: {assistant_count}
-        - Average Length: {avg_length} characters
+        - Average Length: {round(avg_length, 1)} characters
         """
         
         messages.info(request, report)
     generate_conversation_report.short_description = "Generate conversation report"
     
     def get_queryset(self, request):
-        """Custom queryset with annotations"""
-        qs = super().get_queryset(request)
-        return qs.select_related().annotate(
-            message_length=Count('content')
-        )
+        """Custom queryset; the list view only loads what it renders"""
+        qs = super().get_queryset(request).annotate(_length=Length('content'))
+        url_name = getattr(request.resolver_match, 'url_name', '') or ''
+        if (url_name.endswith('_change') and connection.vendor == 'postgresql'
+                and connection.pg_version >= 150000):
+            # Only the change form shows word_count; regexp_count needs
+            # PostgreSQL 15+, and older servers and other backends count in Python
+            qs = qs.annotate(_word_count=Func(
+                'content', Value(r'\S+'), function='regexp_count', output_field=IntegerField()
+            ))
+        if request.method == 'GET' and url_name.endswith('changelist'):
+            # Pull a truncated preview instead of the full content
+            qs = qs.only('id', 'role', 'created_at').annotate(
+                _preview=Substr('content', 1, 101),
+            )
+        return qs
+    
+    def get_message_counts(self):
+        """Get message totals in a single aggregate query, cached briefly"""
+        def compute():
+            today = timezone.now().date()
+            return Message.objects.aggregate(
+                total=Count('id'),
+                user=Count('id', filter=Q(role='user')),
+                assistant=Count('id', filter=Q(role='assistant')),
+                today=Count('id', filter=Q(created_at__date=today)),
+            )
+        
+        return cache.get_or_set('msg_admin_stats', compute, 60)
     
     def changelist_view(self, request, extra_context=None):
         """Custom changelist view with statistics"""
         extra_context = extra_context or {}
+        extra_context['show_statistics_links'] = self.show_statistics_links
         
-        # Get statistics
-        total_messages = Message.objects.count()
-        user_messages = Message.objects.filter(role='user').count()
-        assistant_messages = Message.objects.filter(role='assistant').count()
-        
-        # Recent activity
-        today = timezone.now().date()
-        today_messages = Message.objects.filter(
-            created_at__date=today
-        ).count()
-        
-        # Messages by hour (last 24 hours)
-        from django.db.models.functions import ExtractHour
-        last_24h = timezone.now() - timedelta(hours=24)
-        hourly_stats = Message.objects.filter(
-            created_at__gte=last_24h
-        ).annotate(
-            hour=ExtractHour('created_at')
-        ).values('hour').annotate(count=Count('id')).order_by('hour')
-        
-        # Add statistics links
-        extra_context.update({
-            'total_messages': total_messages,
-            'user_messages': user_messages,
-            'assistant_messages': assistant_messages,
-            'today_messages': today_messages,
-            'hourly_stats': list(hourly_stats),
-            'show_statistics_links': True,
-        })
+        if self.show_statistics_links:
+            counts = self.get_message_counts()
+            
+            # Messages by hour (last 24 hours)
+            from django.db.models.functions import ExtractHour
+            last_24h = timezone.now() - timedelta(hours=24)
+            hourly_stats = Message.objects.filter(
+                created_at__gte=last_24h
+            ).annotate(
+                hour=ExtractHour('created_at')
+            ).values('hour').annotate(count=Count('id')).order_by('hour')
+            
+            # Add statistics links
+            extra_context.update({
+                'total_messages': counts['total'],
+                'user_messages': counts['user'],
+                'assistant_messages': counts['assistant'],
+                'today_messages': counts['today'],
+                'hourly_stats': list(hourly_stats),
+            })
         
         return super().changelist_view(request, extra_context)
     
@@ -211,25 +293,19 @@ class MessageAdmin(admin.ModelAdmin):
         from django.shortcuts import render
         
         # Get various statistics
-        total_messages = Message.objects.count()
-        user_messages = Message.objects.filter(role='user').count()
-        assistant_messages = Message.objects.filter(role='assistant').count()
-        today_messages = Message.objects.filter(
-            created_at__date=timezone.now().date()
-        ).count()
+        counts = self.get_message_counts()
         
         # Calculate average message length properly
-        from django.db.models import Avg
         avg_length_result = Message.objects.aggregate(
-            avg_length=Avg('content')
+            avg_length=Avg(Length('content'))
         )
         avg_message_length = avg_length_result['avg_length'] or 0
         
         stats = {
-            'total_messages': total_messages,
-            'user_messages': user_messages,
-            'assistant_messages': assistant_messages,
-            'today_messages': today_messages,
+            'total_messages': counts['total'],
+            'user_messages': counts['user'],
+            'assistant_messages': counts['assistant'],
+            'today_messages': counts['today'],
             'avg_message_length': round(avg_message_length, 1),
         }
         
@@ -247,6 +323,7 @@ class MessageAdmin(admin.ModelAdmin):
             'messages_by_day': self.get_messages_by_day(),
             'messages_by_hour': self.get_messages_by_hour(),
             'top_conversations': self.get_top_conversations(),
+            'recent_errors': recent_errors(),
         }
         
         return render(request, 'admin/chatbot/analytics.html', {
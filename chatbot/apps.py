@@ -6,5 +6,7 @@ class ChatbotConfig(AppConfig):
     name = 'chatbot'
     
     def ready(self):
-        """Import and register signals when the app is ready"""
+        """Import and register signals, and start loading the semantic cache model"""
         import chatbot.signals
+        from chatbot import semantic_cache
+        semantic_cache.warm_up()
@@ -0,0 +1,33 @@
+import csv
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Larger selections are exported offline with `manage.py export_messages`
+INLINE_EXPORT_LIMIT = 50000
+
+CSV_HEADER = ('ID', 'Role', 'Content', 'Created At', 'Length')
+
+class Echo:
+    """Pseudo-buffer whose write() hands the value back, for streaming csv.writer output"""
+    
+    def write(self, value):
+        return value
+
+def write_messages_csv(queryset, buffer):
+    """Write messages to buffer as CSV, yielding the result of each row write"""
+    writer = csv.writer(buffer)
+    yield writer.writerow(CSV_HEADER)
+    
+    exported = 0
+    for message in queryset.only('id', 'role', 'content', 'created_at').iterator(chunk_size=2000):
+        exported += 1
+        yield writer.writerow([
+            message.id,
+            message.role,
+            message.content,
+            message.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            len(message.content)
+        ])
+    
+    logger.info(f"Exported {exported} messages to CSV")
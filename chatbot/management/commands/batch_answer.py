@@ -0,0 +1,185 @@
+import time
+from collections import deque
+from datetime import timedelta
+import orjson
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from chatbot.models import Message
+from chatbot.views import (
+    CONTEXT_TURNS, HTTP_SESSION, OPENAI_HEADERS, PROVIDER_KIND, PROVIDERS, SYSTEM_PROMPT, ProviderKind
+)
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+# Batch states after which no further progress will be made
+FINAL_STATES = ('completed', 'failed', 'expired', 'cancelled')
+
+class Command(BaseCommand):
+    """Re-answer stored questions through the OpenAI Batch API instead of one call per question"""
+    help = "Regenerate assistant replies with the OpenAI Batch API"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="Only re-answer questions from the last N days")
+        parser.add_argument('--session', help="Only re-answer questions from this session")
+        parser.add_argument('--model', default=PROVIDERS[0]['model'], help="Model to answer with")
+        parser.add_argument('--poll-interval', type=int, default=60, help="Seconds between batch status checks")
+        parser.add_argument('--batch-id', help="Resume waiting on a batch submitted earlier with the same filters")
+        parser.add_argument('--dry-run', action='store_true', help="Only report how many questions would be re-answered")
+        parser.add_argument('--output', help="Write the new replies to this JSONL file instead of over the stored ones")
+    
+    def handle(self, *args, **options):
+        if PROVIDER_KIND is not ProviderKind.OPENAI:
+            raise CommandError("The Batch API needs an OpenAI API key in OPENAI_API_KEY.")
+        # File uploads are multipart, so only the auth header is shared
+        self.auth_headers = {"Authorization": OPENAI_HEADERS["Authorization"]}
+        
+        pairs = self.get_turns(options)
+        if options['dry_run']:
+            self.stdout.write(f"Would re-answer {len(pairs)} questions.")
+            return
+        
+        batch_id = options['batch_id']
+        if batch_id is None:
+            if not pairs:
+                self.stdout.write("No questions to re-answer.")
+                return
+            batch_id = self.submit(pairs, options['model'])
+            self.stdout.write(f"Submitted batch {batch_id} with {len(pairs)} questions")
+        
+        batch = self.wait(batch_id, options['poll_interval'])
+        if batch['status'] != 'completed' or not batch.get('output_file_id'):
+            raise CommandError(f"Batch {batch_id} ended with status {batch['status']}")
+        
+        replies, dropped = self.get_results(batch['output_file_id'], pairs)
+        if dropped:
+            self.stdout.write(self.style.WARNING(
+                f"Skipped {dropped} results that failed or matched no selected question"
+            ))
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                for reply in replies:
+                    f.write(orjson.dumps({"message_id": reply.id, "content": reply.content}) + b"\n")
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {len(replies)} assistant replies from batch {batch_id} to {options['output']}"
+            ))
+        else:
+            Message.objects.bulk_update(replies, ['content'], batch_size=500)
+            self.stdout.write(self.style.SUCCESS(f"Updated {len(replies)} assistant replies from batch {batch_id}"))
+    
+    def get_turns(self, options):
+        """Map each selected user question's id to its prompt and the assistant reply that followed it
+        
+        The prompt holds the same window of earlier turns as build_context did
+        when the question was first asked, so whole sessions are read even when
+        --days only selects their latest questions. Messages without a session
+        are skipped: concurrent conversations interleave there, so a question
+        can't be paired with its reply reliably.
+        """
+        since = timezone.now() - timedelta(days=options['days']) if options['days'] else None
+        queryset = Message.objects.exclude(session_id='').only(
+            'id', 'role', 'content', 'session_id', 'created_at'
+        ).order_by('session_id', 'created_at', 'id')
+        if options['session']:
+            queryset = queryset.filter(session_id=options['session'])
+        if since is not None:
+            queryset = queryset.filter(
+                session_id__in=Message.objects.filter(created_at__gte=since).values('session_id')
+            )
+        
+        pairs = {}
+        previous = prompt = None
+        history = deque(maxlen=CONTEXT_TURNS)
+        for message in queryset.iterator(chunk_size=2000):
+            same_session = previous is not None and previous.session_id == message.session_id
+            if not same_session:
+                history.clear()
+            if message.role == 'user':
+                prompt = [SYSTEM_PROMPT, *history, {"role": "user", "content": message.content}]
+            elif (same_session and previous.role == 'user'
+                    and (since is None or previous.created_at >= since)):
+                pairs[str(previous.id)] = (prompt, message)
+            history.append({"role": message.role, "content": message.content})
+            previous = message
+        return pairs
+    
+    def submit(self, pairs, model):
+        """Upload one request per question and start a batch over them"""
+        lines = b"\n".join(
+            orjson.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "messages": messages,
+                    "max_tokens": 500,
+                    "temperature": 0.2
+                }
+            })
+            for custom_id, (messages, _) in pairs.items()
+        )
+        
+        resp = HTTP_SESSION.post(
+            f"{OPENAI_API_BASE}/files",
+            headers=self.auth_headers,
+            data={"purpose": "batch"},
+            files={"file": ("batch_answer.jsonl", lines, "application/jsonl")},
+            timeout=120
+        )
+        input_file_id = self.parse(resp)["id"]
+        
+        resp = HTTP_SESSION.post(
+            f"{OPENAI_API_BASE}/batches",
+            headers=OPENAI_HEADERS,
+            data=orjson.dumps({
+                "input_file_id": input_file_id,
+                "endpoint": "/v1/chat/completions",
+                "completion_window": "24h"
+            }),
+            timeout=30
+        )
+        return self.parse(resp)["id"]
+    
+    def wait(self, batch_id, poll_interval):
+        """Poll a batch until it reaches a final state"""
+        while True:
+            resp = HTTP_SESSION.get(f"{OPENAI_API_BASE}/batches/{batch_id}", headers=self.auth_headers, timeout=30)
+            batch = self.parse(resp)
+            if batch['status'] in FINAL_STATES:
+                return batch
+            counts = batch.get('request_counts') or {}
+            self.stdout.write(
+                f"Batch {batch_id} is {batch['status']} "
+                f"({counts.get('completed', 0)}/{counts.get('total', 0)} done)"
+            )
+            time.sleep(poll_interval)
+    
+    def get_results(self, output_file_id, pairs):
+        """Download the batch output and set each new reply on its stored message
+        
+        Returns the updated replies and how many results couldn't be used.
+        """
+        resp = HTTP_SESSION.get(f"{OPENAI_API_BASE}/files/{output_file_id}/content", headers=self.auth_headers, timeout=120)
+        if resp.status_code != 200:
+            raise CommandError(f"Could not download batch output (Status {resp.status_code}): {resp.text[:200]}")
+        
+        replies = []
+        dropped = 0
+        for line in resp.content.splitlines():
+            if not line:
+                continue
+            result = orjson.loads(line)
+            response = result.get('response') or {}
+            if result.get('custom_id') not in pairs or response.get('status_code') != 200:
+                dropped += 1
+                continue
+            _, reply = pairs[result['custom_id']]
+            reply.content = response['body']['choices'][0]['message']['content']
+            replies.append(reply)
+        return replies, dropped
+    
+    def parse(self, resp):
+        """Decode a Batch API response, failing the command on errors"""
+        if resp.status_code != 200:
+            raise CommandError(f"OpenAI API Error (Status {resp.status_code}): {resp.text[:200]}")
+        return orjson.loads(resp.content)
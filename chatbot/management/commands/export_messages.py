@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chatbot.exports import write_messages_csv
+from chatbot.models import Message
+
+class Command(BaseCommand):
+    """Export messages to a CSV file without tying up a web worker"""
+    help = "Export chat messages to a CSV file"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the CSV file to write")
+        parser.add_argument('--role', help="Only export messages with this role")
+        parser.add_argument('--days', type=int, help="Only export messages from the last N days")
+        parser.add_argument('--since', type=datetime.fromisoformat, help="Only export messages created at or after this ISO time")
+        parser.add_argument('--until', type=datetime.fromisoformat, help="Only export messages created at or before this ISO time")
+    
+    def handle(self, *args, **options):
+        queryset = Message.objects.order_by('-created_at')
+        if options['role']:
+            queryset = queryset.filter(role=options['role'])
+        if options['days']:
+            queryset = queryset.filter(created_at__gte=timezone.now() - timedelta(days=options['days']))
+        if options['since']:
+            queryset = queryset.filter(created_at__gte=options['since'])
+        if options['until']:
+            queryset = queryset.filter(created_at__lte=options['until'])
+        
+        with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+            # The header row is yielded first, so don't count it
+            exported = sum(1 for _ in write_messages_csv(queryset, f)) - 1
+        
+        self.stdout.write(self.style.SUCCESS(f"Exported {exported} messages to {options['output']}"))
@@ -0,0 +1,24 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    """Report how often AI replies were served from the response cache"""
+    help = "Show AI response cache hit/miss counts"
+    
+    def handle(self, *args, **options):
+        counts = cache.get_many([
+            'response_cache_hits', 'response_cache_misses', 'semantic_cache_hits', 'inflight_coalesced'
+        ])
+        hits = counts.get('response_cache_hits', 0)
+        misses = counts.get('response_cache_misses', 0)
+        semantic_hits = counts.get('semantic_cache_hits', 0)
+        coalesced = counts.get('inflight_coalesced', 0)
+        total = hits + misses
+        hit_rate = (hits / total * 100) if total else 0
+        
+        self.stdout.write(f"Hits: {hits}")
+        self.stdout.write(
+            f"Misses: {misses} ({semantic_hits} served by the semantic cache, "
+            f"{coalesced} by an identical in-flight request)"
+        )
+        self.stdout.write(f"Hit rate: {hit_rate:.1f}%")
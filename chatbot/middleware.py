@@ -5,48 +5,78 @@ from django.utils.deprecation import MiddlewareMixin
 from django.core.cache import cache
 from django.http import JsonResponse
 from django.conf import settings
-from .signals import conversation_started, conversation_ended, error_occurred
+from .signals import conversation_started, conversation_ended, bump, record_error
 
 logger = logging.getLogger(__name__)
 
+# Security headers, including the Content Security Policy
+SECURITY_HEADERS = (
+    ('X-Content-Type-Options', 'nosniff'),
+    ('X-Frame-Options', 'DENY'),
+    ('X-XSS-Protection', '1; mode=block'),
+    ('Referrer-Policy', 'strict-origin-when-cross-origin'),
+    ('Content-Security-Policy', (
+        "default-src 'self'; "
+        "script-src 'self' 'unsafe-inline' cdnjs.cloudflare.com; "
+        "style-src 'self' 'unsafe-inline' fonts.googleapis.com cdnjs.cloudflare.com; "
+        "font-src 'self' fonts.gstatic.com; "
+        "img-src 'self' data:; "
+        "connect-src 'self';"
+    )),
+)
+
+class RequestContextMiddleware(MiddlewareMixin):
+    """Middleware to compute per-request values shared by the rest of the stack"""
+    
+    def process_request(self, request):
+        """Resolve the API flag and client IP once per request"""
+        request._is_api = request.path.startswith('/api/')
+        
+        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+        if x_forwarded_for:
+            request._client_ip = x_forwarded_for.split(',')[0]
+        else:
+            request._client_ip = request.META.get('REMOTE_ADDR')
+
 class RequestLoggingMiddleware(MiddlewareMixin):
     """Middleware to log all requests and responses"""
     
     def process_request(self, request):
         """Log incoming requests"""
-        request.start_time = time.time()
-        
-        # Log request details
-        log_data = {
-            'method': request.method,
-            'path': request.path,
-            'user_agent': request.META.get('HTTP_USER_AGENT', ''),
-            'ip_address': self.get_client_ip(request),
-            'timestamp': time.time()
-        }
+        request.start_time = time.monotonic()
         
-        logger.info(f"Request: {json.dumps(log_data)}")
+        # Log request details; skip building the payload when INFO is off
+        if logger.isEnabledFor(logging.INFO):
+            log_data = {
+                'method': request.method,
+                'path': request.path,
+                'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+                'ip_address': request._client_ip,
+                'timestamp': time.time()
+            }
+            
+            logger.info("Request: %s", json.dumps(log_data))
         
         # Track API usage
-        if request.path.startswith('/api/'):
-            api_requests = cache.get('api_requests_count', 0)
-            cache.set('api_requests_count', api_requests + 1, 3600)
+        if request._is_api:
+            bump('api_requests_count')
     
     def process_response(self, request, response):
         """Log response details"""
         if hasattr(request, 'start_time'):
-            duration = time.time() - request.start_time
+            duration = time.monotonic() - request.start_time
             
             # Log response details
-            log_data = {
-                'method': request.method,
-                'path': request.path,
-                'status_code': response.status_code,
-                'duration': round(duration, 3),
-                'timestamp': time.time()
-            }
-            
-            logger.info(f"Response: {json.dumps(log_data)}")
+            if logger.isEnabledFor(logging.INFO):
+                log_data = {
+                    'method': request.method,
+                    'path': request.path,
+                    'status_code': response.status_code,
+                    'duration': round(duration, 3),
+                    'timestamp': time.time()
+                }
+                
+                logger.info("Response: %s", json.dumps(log_data))
             
             # Track slow requests
             if duration > 2.0:  # Log requests taking more than 2 seconds
@@ -56,21 +86,13 @@ class RequestLoggingMiddleware(MiddlewareMixin):
             response['X-Response-Time'] = f"{duration:.3f}s"
         
         return response
-    
-    def get_client_ip(self, request):
-        """Get client IP address"""
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
 
 class ChatAnalyticsMiddleware(MiddlewareMixin):
     """Middleware to track chat-specific analytics"""
     
     def process_request(self, request):
         """Track chat-related requests"""
+        # API chat starts are signalled from chat_api once DRF has parsed the body
         if request.path == '/' and request.method == 'POST':
             # Track new conversation starts
             user_message = request.POST.get('message', '')
@@ -79,19 +101,6 @@ class ChatAnalyticsMiddleware(MiddlewareMixin):
                     sender=self.__class__,
                     user_message=user_message
                 )
-        
-        elif request.path == '/api/chat/' and request.method == 'POST':
-            # Track API chat requests
-            try:
-                body = json.loads(request.body.decode('utf-8'))
-                user_message = body.get('message', '')
-                if user_message:
-                    conversation_started.send(
-                        sender=self.__class__,
-                        user_message=user_message
-                    )
-            except (json.JSONDecodeError, UnicodeDecodeError):
-                pass
 
 class ErrorHandlingMiddleware(MiddlewareMixin):
     """Middleware to handle and log errors"""
@@ -108,15 +117,10 @@ class ErrorHandlingMiddleware(MiddlewareMixin):
         
         logger.error(f"Exception occurred: {json.dumps(error_data)}")
         
-        # Send error signal
-        error_occurred.send(
-            sender=self.__class__,
-            error_type=type(exception).__name__,
-            error_message=str(exception)
-        )
+        record_error(type(exception).__name__, str(exception))
         
         # Return JSON error response for API requests
-        if request.path.startswith('/api/'):
+        if request._is_api:
             return JsonResponse({
                 'error': 'Internal server error',
                 'error_type': 'server_error'
@@ -127,55 +131,49 @@ class ErrorHandlingMiddleware(MiddlewareMixin):
 class RateLimitingMiddleware(MiddlewareMixin):
     """Simple rate limiting middleware"""
     
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        self.redis = None
+        if settings.CACHES['default']['BACKEND'].startswith('django_redis.'):
+            from django_redis import get_redis_connection
+            self.redis = get_redis_connection('default')
+    
+    def count_request(self, cache_key, ttl):
+        """Increment the request counter and return the new value in one round-trip"""
+        if self.redis is None:
+            return bump(cache_key, ttl)
+        
+        # Create the window with its expiry only if missing, then increment
+        key = cache.make_key(cache_key)
+        pipe = self.redis.pipeline()
+        pipe.set(key, 0, ex=ttl, nx=True)
+        pipe.incr(key)
+        _, request_count = pipe.execute()
+        return request_count
+    
     def process_request(self, request):
         """Check rate limits"""
-        if request.path.startswith('/api/'):
-            client_ip = self.get_client_ip(request)
+        if request._is_api:
+            client_ip = request._client_ip
             cache_key = f"rate_limit_{client_ip}"
             
-            # Get current request count
-            request_count = cache.get(cache_key, 0)
+            # Count this request; the returned value is exact under concurrency
+            request_count = self.count_request(cache_key, 3600)  # 1 hour expiry
             
             # Rate limit: 100 requests per hour
-            if request_count >= 100:
+            if request_count > 100:
                 logger.warning(f"Rate limit exceeded for IP: {client_ip}")
                 return JsonResponse({
                     'error': 'Rate limit exceeded. Please try again later.',
                     'error_type': 'rate_limit'
                 }, status=429)
-            
-            # Increment request count
-            cache.set(cache_key, request_count + 1, 3600)  # 1 hour expiry
-    
-    def get_client_ip(self, request):
-        """Get client IP address"""
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
 
 class SecurityHeadersMiddleware(MiddlewareMixin):
     """Middleware to add security headers"""
     
     def process_response(self, request, response):
-        """Add security headers to response"""
-        # Security headers
-        response['X-Content-Type-Options'] = 'nosniff'
-        response['X-Frame-Options'] = 'DENY'
-        response['X-XSS-Protection'] = '1; mode=block'
-        response['Referrer-Policy'] = 'strict-origin-when-cross-origin'
-        
-        # Content Security Policy
-        csp = (
-            "default-src 'self'; "
-            "script-src 'self' 'unsafe-inline' cdnjs.cloudflare.com; "
-            "style-src 'self' 'unsafe-inline' fonts.googleapis.com cdnjs.cloudflare.com; "
-            "font-src 'self' fonts.gstatic.com; "
-            "img-src 'self' data:; "
-            "connect-src 'self';"
-        )
-        response['Content-Security-Policy'] = csp
+        """Add security headers to response, keeping any the view already set"""
+        for header, value in SECURITY_HEADERS:
+            response.setdefault(header, value)
         
         return response
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-14 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='session_id',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=40),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.5 on 2026-10-14 12:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_cachedresponse'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='session_id',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['created_at'], name='chatbot_mes_created_2fef1d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['session_id', 'created_at'], name='chatbot_mes_session_eb2d97_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['role', 'created_at'], name='chatbot_mes_role_77257c_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-14 12:34
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0004_message_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['created_at']},
+        ),
+    ]
@@ -6,6 +6,29 @@ class Message(models.Model):
     role = models.CharField(max_length=20)  # 'user' or 'assistant'
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    session_id = models.CharField(max_length=40, blank=True, default='')  # browser session key
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['created_at']),
+            models.Index(fields=['session_id', 'created_at']),
+            models.Index(fields=['role', 'created_at']),
+        ]
+
+    def __str__(self):
+        # Admin list views load a truncated `_preview` instead of the full content
+        content = getattr(self, '_preview', None)
+        if content is None:
+            content = self.content
+        return f"{self.role}: {content[:50]}"
+
+class CachedResponse(models.Model):
+    """AI reply stored with the embedding of the question that produced it"""
+    embedding = models.BinaryField()  # float32, L2-normalized
+    response = models.TextField()
+    context_hash = models.CharField(max_length=64, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"{self.role}: {self.content[:50]}"
+        return self.response[:50]
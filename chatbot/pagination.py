@@ -0,0 +1,5 @@
+from rest_framework.pagination import CursorPagination
+
+class MessagePagination(CursorPagination):
+    """Keep message list responses bounded without large OFFSET scans"""
+    ordering = 'created_at'
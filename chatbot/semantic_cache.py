@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import CachedResponse
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+# Minimum cosine similarity for a cached reply to be reused
+SIMILARITY_THRESHOLD = 0.92
+
+# Newest cached entries compared per lookup
+MAX_CANDIDATES = 1000
+
+# Contexts kept in this process's index, least recently used dropped first
+MAX_INDEXED_CONTEXTS = 256
+
+# Seconds before a context's index is reloaded to pick up other processes' replies
+INDEX_REFRESH = 300
+
+# Seconds between deletes of expired rows
+PRUNE_INTERVAL = 3600
+
+_model = None
+_model_lock = threading.Lock()
+
+# context hash -> (loaded at, embedding matrix, created_at timestamps, replies)
+_index = OrderedDict()
+_index_lock = threading.Lock()
+_next_prune = 0.0
+
+def get_model():
+    """Load the embedding model once; None when the cache is disabled or unavailable"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                model = False
+                if settings.SEMANTIC_CACHE_ENABLED:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                        model = SentenceTransformer(EMBEDDING_MODEL)
+                    except ImportError:
+                        logger.warning("SEMANTIC_CACHE_ENABLED is set but sentence-transformers is not installed")
+                _model = model
+    return _model or None
+
+def warm_up():
+    """Load the embedding model in the background so the first request doesn't pay for it"""
+    if settings.SEMANTIC_CACHE_ENABLED:
+        threading.Thread(target=get_model, name='semantic-cache-warm-up', daemon=True).start()
+
+def context_hash(context):
+    """Hash the two turns before the current one, so replies are only reused in the same context"""
+    previous = [(m["role"], m["content"]) for m in context[-2:]]
+    return hashlib.sha256(json.dumps(previous).encode()).hexdigest()
+
+def embed(model, text):
+    """L2-normalized float32 embedding of text"""
+    import numpy as np
+    return model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+def expiry_cutoff():
+    """Oldest created_at still served from the cache"""
+    return timezone.now() - timedelta(seconds=settings.SEMANTIC_CACHE_TTL)
+
+def load_entry(key):
+    """Read a context's newest unexpired replies from the database"""
+    import numpy as np
+    rows = list(
+        CachedResponse.objects.filter(
+            context_hash=key, created_at__gte=expiry_cutoff()
+        ).order_by('-created_at').values_list('embedding', 'created_at', 'response')[:MAX_CANDIDATES]
+    )
+    if rows:
+        matrix = np.stack([np.frombuffer(embedding, dtype=np.float32) for embedding, _, _ in rows])
+    else:
+        matrix = np.empty((0, 0), dtype=np.float32)
+    created = np.array([created_at.timestamp() for _, created_at, _ in rows])
+    return time.monotonic(), matrix, created, [response for _, _, response in rows]
+
+def get_entry(key):
+    """A context's indexed replies, reloading them once INDEX_REFRESH has passed"""
+    with _index_lock:
+        entry = _index.get(key)
+        if entry is not None and time.monotonic() - entry[0] < INDEX_REFRESH:
+            _index.move_to_end(key)
+            return entry
+
+    entry = load_entry(key)
+    with _index_lock:
+        _index[key] = entry
+        _index.move_to_end(key)
+        while len(_index) > MAX_INDEXED_CONTEXTS:
+            _index.popitem(last=False)
+    return entry
+
+def lookup(user_input, context):
+    """Return a cached reply to a similar question asked in the same context, or None"""
+    model = get_model()
+    if model is None:
+        return None
+    import numpy as np
+
+    _, matrix, created, responses = get_entry(context_hash(context))
+    if not responses:
+        return None
+
+    # Embeddings are normalized, so the dot product is the cosine similarity
+    scores = matrix @ embed(model, user_input)
+    # Replies that expired since the entry was loaded are never reused
+    scores[created < expiry_cutoff().timestamp()] = -1.0
+    best = int(scores.argmax())
+    if scores[best] > SIMILARITY_THRESHOLD:
+        return responses[best]
+    return None
+
+def store(user_input, context, response):
+    """Remember a reply for future similar questions"""
+    model = get_model()
+    if model is None:
+        return
+    import numpy as np
+
+    key = context_hash(context)
+    embedding = embed(model, user_input)
+    cached = CachedResponse.objects.create(
+        embedding=embedding.tobytes(),
+        response=response,
+        context_hash=key
+    )
+
+    # Newest first, like load_entry; contexts not yet indexed are loaded on their next lookup
+    with _index_lock:
+        entry = _index.get(key)
+        if entry is not None:
+            loaded_at, matrix, created, responses = entry
+            matrix = np.vstack([embedding, matrix]) if responses else embedding[None, :]
+            _index[key] = (
+                loaded_at,
+                matrix[:MAX_CANDIDATES],
+                np.concatenate([[cached.created_at.timestamp()], created])[:MAX_CANDIDATES],
+                [response, *responses][:MAX_CANDIDATES]
+            )
+
+    prune()
+
+def prune():
+    """Delete expired rows, at most once per PRUNE_INTERVAL in each process"""
+    global _next_prune
+    now = time.monotonic()
+    if now < _next_prune:
+        return
+    _next_prune = now + PRUNE_INTERVAL
+    deleted, _ = CachedResponse.objects.filter(created_at__lt=expiry_cutoff()).delete()
+    if deleted:
+        logger.info("Pruned %s expired semantic cache entries", deleted)
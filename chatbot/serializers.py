@@ -2,6 +2,8 @@ from rest_framework import serializers
 from .models import Message
 
 class MessageSerializer(serializers.ModelSerializer):
+    created_at = serializers.DateTimeField(read_only=True)
+    
     class Meta:
         model = Message
         fields = ['id', 'role', 'content', 'created_at']
@@ -9,6 +11,8 @@ class MessageSerializer(serializers.ModelSerializer):
 
 class ChatRequestSerializer(serializers.Serializer):
     message = serializers.CharField(max_length=1000, min_length=1)
+    # Lets API clients without a session cookie keep a conversation's context
+    session_id = serializers.CharField(max_length=40, required=False, allow_blank=True)
 
 class ChatResponseSerializer(serializers.Serializer):
     response = serializers.CharField()
@@ -3,35 +3,47 @@ from django.dispatch import receiver
 from django.core.cache import cache
 from django.utils import timezone
 from .models import Message
+from collections import deque
 import logging
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-@receiver(post_save, sender=Message)
-def message_post_save(sender, instance, created, **kwargs):
-    """Signal handler for when a message is saved"""
-    if created:
-        logger.info(f"New {instance.role} message created: {instance.content[:50]}...")
-        
-        # Update cache with latest message count
-        cache_key = f"message_count_{instance.role}"
-        current_count = cache.get(cache_key, 0)
-        cache.set(cache_key, current_count + 1, 3600)  # Cache for 1 hour
-        
-        # Update total message count
-        total_count = cache.get("total_message_count", 0)
-        cache.set("total_message_count", total_count + 1, 3600)
-        
-        # Log conversation statistics
-        user_messages = Message.objects.filter(role='user').count()
-        assistant_messages = Message.objects.filter(role='assistant').count()
-        
-        logger.info(f"Conversation stats - User: {user_messages}, Assistant: {assistant_messages}")
+def bump(key, ttl=3600, delta=1):
+    """Atomically increment a cache counter, creating it if missing"""
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        if cache.add(key, delta, ttl):
+            return delta
+        # Another writer created the key first
+        return cache.incr(key, delta)
 
-@receiver(pre_save, sender=Message)
-def message_pre_save(sender, instance, **kwargs):
-    """Signal handler for before a message is saved"""
+def unbump(key, ttl=3600):
+    """Atomically decrement a cache counter; missing counters are left alone"""
+    try:
+        if cache.decr(key) < 0:
+            cache.set(key, 0, ttl)
+    except ValueError:
+        pass
+
+def count_new_message(instance):
+    """Log a newly created message and update the cached message counts"""
+    logger.info(f"New {instance.role} message created: {instance.content[:50]}...")
+    
+    # Update cached message counts
+    bump(f"message_count_{instance.role}")
+    bump("total_message_count")
+    
+    # Log conversation statistics from the cached counters
+    counts = cache.get_many(['message_count_user', 'message_count_assistant'])
+    user_messages = counts.get('message_count_user', 0)
+    assistant_messages = counts.get('message_count_assistant', 0)
+    
+    logger.info(f"Conversation stats - User: {user_messages}, Assistant: {assistant_messages}")
+
+def prepare_message(instance):
+    """Validate and truncate a message's content before it is written"""
     # Ensure content is not empty
     if not instance.content or instance.content.strip() == "":
         raise ValueError("Message content cannot be empty")
@@ -41,27 +53,31 @@ def message_pre_save(sender, instance, **kwargs):
         instance.content = instance.content[:4997] + "..."
         logger.warning(f"Message content truncated for message ID {instance.id}")
 
+@receiver(post_save, sender=Message)
+def message_post_save(sender, instance, created, **kwargs):
+    """Signal handler for when a message is saved"""
+    if created:
+        count_new_message(instance)
+
+@receiver(pre_save, sender=Message)
+def message_pre_save(sender, instance, **kwargs):
+    """Signal handler for before a message is saved"""
+    prepare_message(instance)
+
 @receiver(post_delete, sender=Message)
 def message_post_delete(sender, instance, **kwargs):
     """Signal handler for when a message is deleted"""
     logger.info(f"Message deleted: {instance.role} - {instance.content[:50]}...")
     
     # Update cache counts
-    cache_key = f"message_count_{instance.role}"
-    current_count = cache.get(cache_key, 0)
-    if current_count > 0:
-        cache.set(cache_key, current_count - 1, 3600)
-    
-    total_count = cache.get("total_message_count", 0)
-    if total_count > 0:
-        cache.set("total_message_count", total_count - 1, 3600)
+    unbump(f"message_count_{instance.role}")
+    unbump("total_message_count")
 
 # Custom signal for conversation events
 from django.dispatch import Signal
 
 conversation_started = Signal()
 conversation_ended = Signal()
-error_occurred = Signal()
 
 @receiver(conversation_started)
 def handle_conversation_started(sender, user_message, **kwargs):
@@ -76,24 +92,34 @@ def handle_conversation_ended(sender, conversation_length, **kwargs):
     """Handle conversation end events"""
     logger.info(f"Conversation ended with {conversation_length} messages")
     
-    # Track conversation metrics
-    cache_key = "avg_conversation_length"
-    current_avg = cache.get(cache_key, 0)
-    total_conversations = cache.get("total_conversations", 0)
-    
-    if total_conversations > 0:
-        new_avg = ((current_avg * total_conversations) + conversation_length) / (total_conversations + 1)
-    else:
-        new_avg = conversation_length
-    
-    cache.set(cache_key, new_avg, 3600)
-    cache.set("total_conversations", total_conversations + 1, 3600)
+    # Track conversation metrics; the average is derived on read
+    bump("conversation_length_sum", delta=conversation_length)
+    bump("total_conversations")
 
-@receiver(error_occurred)
-def handle_error_occurred(sender, error_type, error_message, **kwargs):
-    """Handle error events"""
-    logger.error(f"Error occurred - Type: {error_type}, Message: {error_message}")
-    
-    # Track error statistics
-    error_count = cache.get(f"error_count_{error_type}", 0)
-    cache.set(f"error_count_{error_type}", error_count + 1, 3600)
+def get_avg_conversation_length():
+    """Average conversation length from the cached sum and count"""
+    totals = cache.get_many(["conversation_length_sum", "total_conversations"])
+    total_conversations = totals.get("total_conversations", 0)
+    if not total_conversations:
+        return 0
+    return totals.get("conversation_length_sum", 0) / total_conversations
+
+# Most recent errors in this process, newest last
+ERROR_RING = deque(maxlen=1024)
+
+def record_error(error_type, error_message):
+    """Log an error and count it by type"""
+    ERROR_RING.append((timezone.now(), error_type, error_message))
+    logger.warning("%s: %s", error_type, error_message)
+    bump(f"error_count_{error_type}")
+
+def recent_errors(limit=20):
+    """Most recent recorded errors, newest first"""
+    return [
+        {
+            'time': occurred_at,
+            'error_type': error_type,
+            'error_message': error_message,
+        }
+        for occurred_at, error_type, error_message in reversed(list(ERROR_RING)[-limit:])
+    ]
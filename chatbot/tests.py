@@ -1,3 +1,492 @@
-from django.test import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from io import StringIO
+from collections import OrderedDict
+from unittest import mock, skipUnless
+import sys
+import threading
+import time
+import orjson
+import requests
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from . import admin as message_admin, semantic_cache, views
+from .management.commands import batch_answer
+from .models import CachedResponse, Message
+from .views import ProviderKind
 
-# Create your tests here.
+try:
+    import numpy
+except ImportError:  # only the semantic cache needs it
+    numpy = None
+
+OPENAI, OPENROUTER = views.PROVIDERS
+
+def provider_response(status_code, content=b'{"error": "denied"}'):
+    """A canned provider HTTP response"""
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp._content = content
+    return resp
+
+class ProviderTestCase(TestCase):
+    """Start every test without cached replies or a remembered key rejection"""
+    
+    def setUp(self):
+        cache.clear()
+        views._AUTH_FAILED_UNTIL = 0.0
+        self.addCleanup(setattr, views, '_AUTH_FAILED_UNTIL', 0.0)
+
+class ProviderAuthTests(ProviderTestCase):
+    """A 401 only marks the key rejected when its own provider refused it"""
+    
+    messages = [views.SYSTEM_PROMPT, {"role": "user", "content": "What is a tort?"}]
+    
+    def use_key_for(self, cfg, chain):
+        for name, value in (
+            ('PROVIDER_KIND', cfg["kind"]),
+            ('PRIMARY_PROVIDER', cfg),
+            ('ALTERNATIVE_PROVIDERS', views.build_alternative_providers(cfg["kind"])),
+            ('PROVIDER_CHAIN', chain),
+        ):
+            patcher = mock.patch.object(views, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def test_openrouter_key_gets_no_openai_alternatives(self):
+        self.assertEqual(views.build_alternative_providers(ProviderKind.OPENROUTER), ())
+        self.assertTrue(views.build_alternative_providers(ProviderKind.OPENAI))
+    
+    def test_openai_401_does_not_reject_openrouter_key(self):
+        self.use_key_for(OPENROUTER, (views.try_primary_api,))
+        with mock.patch.object(views.HTTP_SESSION, 'post', return_value=provider_response(401)):
+            response = views.call_provider(OPENAI, self.messages)
+        
+        self.assertEqual(response['error_type'], 'auth_error')
+        self.assertFalse(views.api_key_rejected())
+    
+    def test_openrouter_outage_keeps_key_usable(self):
+        self.use_key_for(OPENROUTER, (views.try_primary_api,))
+        with mock.patch.object(views.HTTP_SESSION, 'post', return_value=provider_response(500)) as post:
+            first = views.fetch_ai_response(self.messages)
+            second = views.fetch_ai_response(self.messages)
+        
+        self.assertEqual(first['error_type'], 'all_apis_failed')
+        self.assertEqual(second['error_type'], 'all_apis_failed')
+        self.assertEqual([call.args[0] for call in post.call_args_list], [OPENROUTER["url"]] * 2)
+        self.assertFalse(views.api_key_rejected())
+    
+    def test_primary_401_short_circuits_later_requests(self):
+        self.use_key_for(OPENAI, (views.try_primary_api, views.try_alternative_openai_api))
+        with mock.patch.object(views.HTTP_SESSION, 'post', return_value=provider_response(401)) as post:
+            first = views.fetch_ai_response(self.messages)
+            calls = post.call_count
+            second = views.fetch_ai_response(self.messages)
+        
+        self.assertEqual(first['error_type'], 'configuration_error')
+        self.assertEqual(second['error_type'], 'configuration_error')
+        self.assertEqual(post.call_count, calls)
+        self.assertTrue(views.api_key_rejected())
+
+class ProviderRetryTests(ProviderTestCase):
+    """Completions are billed once sent, so only unsent or gateway-refused POSTs are retried"""
+    
+    def serve(self, handle):
+        posts = []
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                posts.append(self.path)
+                handle(self)
+            
+            def log_message(self, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        
+        # Route plain http through the provider adapter and its retry policy
+        session = requests.Session()
+        session.mount('http://', views.HTTP_SESSION.get_adapter('https://api.openai.com'))
+        patcher = mock.patch.object(views, 'HTTP_SESSION', session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return {**OPENAI, "url": f"http://127.0.0.1:{server.server_port}/"}, posts
+    
+    def test_pool_keeps_a_connection_per_worker(self):
+        def slow_reply(handler):
+            time.sleep(0.2)
+            body = b'{"choices": [{"message": {"content": "ok"}}]}'
+            handler.send_response(200)
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        cfg, posts = self.serve(slow_reply)
+        
+        with self.assertNoLogs('urllib3.connectionpool', 'WARNING'):
+            futures = [
+                views.provider_pool.submit(views.call_provider, cfg, [])
+                for _ in range(views.settings.PROVIDER_POOL_SIZE)
+            ]
+            self.assertTrue(all(f.result()['success'] for f in futures))
+    
+    def test_read_timeout_is_not_retried(self):
+        def stall(handler):
+            time.sleep(1)
+        
+        cfg, posts = self.serve(stall)
+        with mock.patch.object(views, 'PROVIDER_TIMEOUT', 0.3):
+            response = views.call_provider(cfg, [])
+        
+        self.assertEqual(response['error_type'], 'timeout')
+        self.assertEqual(len(posts), 1)
+    
+    def test_gateway_errors_are_retried(self):
+        def unavailable(handler):
+            handler.send_response(503)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+        
+        cfg, posts = self.serve(unavailable)
+        response = views.call_provider(cfg, [])
+        
+        self.assertEqual(response['error_type'], 'api_error')
+        self.assertEqual(len(posts), 3)
+
+class ProviderHedgingTests(ProviderTestCase):
+    """The fallback race must not duplicate the primary or pile up threads"""
+    
+    def test_alternatives_skip_the_primary_request(self):
+        models = [cfg["model"] for cfg in views.build_alternative_providers(ProviderKind.OPENAI)]
+        self.assertNotIn(OPENAI["model"], models)
+    
+    def test_head_start_follows_observed_p95(self):
+        with mock.patch.object(views, 'primary_latencies', []):
+            self.assertEqual(views.provider_head_start(), views.settings.PROVIDER_HEAD_START)
+        with mock.patch.object(views, 'primary_latencies', [float(n) for n in range(1, 101)]):
+            self.assertEqual(views.provider_head_start(), 95.0)
+    
+    def test_hedges_are_dropped_without_a_free_slot(self):
+        calls = []
+        
+        def slow_primary(messages_for_gpt):
+            calls.append('primary')
+            time.sleep(0.3)
+            return {'success': True, 'response': 'primary reply'}
+        
+        def alternative(messages_for_gpt):
+            calls.append('alternative')
+            return {'success': True, 'response': 'alternative reply'}
+        
+        with mock.patch.object(views, 'PROVIDER_CHAIN', (slow_primary, alternative)), \
+                mock.patch.object(views, 'provider_head_start', return_value=0.05), \
+                mock.patch.object(views, 'hedge_slots', threading.BoundedSemaphore(1)) as slots:
+            slots.acquire()
+            response = views.fetch_ai_response([])
+        
+        self.assertEqual(response['response'], 'primary reply')
+        self.assertEqual(calls, ['primary'])
+
+class ChatApiSessionTests(ProviderTestCase):
+    """API calls take their conversation from session_id or the cookie, never a new session"""
+    
+    def post_chat(self, body):
+        reply = {'success': True, 'response': 'A tort is a civil wrong.'}
+        with mock.patch.object(views, 'PROVIDER_KIND', ProviderKind.OPENAI), \
+                mock.patch.object(views, 'fetch_ai_response', return_value=reply) as fetch:
+            response = self.client.post('/api/chat/', body, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return fetch.call_args.args[0]
+    
+    def test_cookieless_call_creates_no_session(self):
+        self.post_chat({'message': 'What is a tort?'})
+        
+        self.assertFalse(Session.objects.exists())
+        self.assertFalse(Message.objects.exclude(session_id='').exists())
+    
+    def test_session_id_carries_context(self):
+        self.post_chat({'message': 'What is a tort?', 'session_id': 'client-1'})
+        messages_for_gpt = self.post_chat({'message': 'Give an example', 'session_id': 'client-1'})
+        
+        self.assertEqual(
+            [m['content'] for m in messages_for_gpt[1:]],
+            ['What is a tort?', 'A tort is a civil wrong.', 'Give an example']
+        )
+
+class StreamFallbackTests(ProviderTestCase):
+    """A stream refused before any text falls back to the alternatives only"""
+    
+    def stream(self, status_code):
+        with mock.patch.object(views.HTTP_SESSION, 'post', return_value=provider_response(status_code)) as post, \
+                mock.patch.object(views, 'FALLBACK_CHAIN', (views.try_alternative_openai_api,)), \
+                mock.patch.object(views, 'fetch_ai_response', return_value={'success': True, 'response': 'fallback reply'}) as fetch:
+            events = list(views.stream_chat_events('What is a tort?', 'client-1'))
+        return events, post, fetch
+    
+    def test_rate_limit_is_returned_without_fallback(self):
+        events, post, fetch = self.stream(429)
+        
+        self.assertEqual(post.call_count, 1)
+        fetch.assert_not_called()
+        self.assertTrue(events[-1].startswith('event: error'))
+        self.assertIn('rate_limit', events[-1])
+    
+    def test_server_error_falls_back_to_alternatives_only(self):
+        events, post, fetch = self.stream(500)
+        
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(fetch.call_args.args[1], (views.try_alternative_openai_api,))
+        self.assertIn('fallback reply', events[0])
+        self.assertTrue(events[-1].startswith('event: done'))
+
+class ResponseCacheTests(ProviderTestCase):
+    """Questions differing only in case, width or outer spaces share a cache entry"""
+    
+    def test_equivalent_questions_share_a_key(self):
+        keys = {
+            views.response_cache_key(views.PROVIDER_MODEL, [views.SYSTEM_PROMPT, {"role": "user", "content": text}])
+            for text in ("Hello ", "hello", "ＨＥＬＬＯ")
+        }
+        self.assertEqual(len(keys), 1)
+    
+    def test_provider_gets_the_original_text(self):
+        reply = {'success': True, 'response': 'Hi.'}
+        with mock.patch.object(views, 'fetch_ai_response', return_value=reply) as fetch:
+            views.get_ai_response_external_only("ＨＥＬＬＯ")
+            cached = views.get_ai_response_external_only("hello ")
+        
+        fetch.assert_called_once()
+        self.assertEqual(fetch.call_args.args[0][-1]['content'], "ＨＥＬＬＯ")
+        self.assertEqual(cached['response'], 'Hi.')
+    
+    def test_cache_hit_still_saves_the_turn(self):
+        reply = {'success': True, 'response': 'A civil wrong.'}
+        with mock.patch.object(views, 'PROVIDER_KIND', ProviderKind.OPENAI), \
+                mock.patch.object(views, 'fetch_ai_response', return_value=reply) as fetch:
+            for _ in range(2):
+                response = self.client.post('/api/chat/', {'message': 'What is a tort?'}, content_type='application/json')
+                self.assertEqual(response.status_code, 200)
+        
+        fetch.assert_called_once()
+        self.assertEqual(Message.objects.filter(role='assistant', content='A civil wrong.').count(), 2)
+
+class BatchAnswerTests(TestCase):
+    """Re-answered questions keep the turns that came before them"""
+    
+    def setUp(self):
+        old = timezone.now() - timedelta(days=10)
+        for i, (role, content) in enumerate([
+            ('user', 'What is a tort?'), ('assistant', 'A civil wrong.'),
+            ('user', 'Give an example'), ('assistant', 'Negligence.'),
+        ]):
+            message = Message.objects.create(session_id='s1', role=role, content=content)
+            # Only the follow-up falls inside --days 1
+            if i < 2:
+                Message.objects.filter(pk=message.pk).update(created_at=old + timedelta(seconds=i))
+    
+    def get_turns(self, **options):
+        return batch_answer.Command().get_turns({'session': None, 'days': None, **options})
+    
+    def test_prompt_includes_earlier_turns(self):
+        prompts = [prompt for prompt, _ in self.get_turns(days=1).values()]
+        
+        self.assertEqual(len(prompts), 1)
+        self.assertEqual(
+            [m['content'] for m in prompts[0][1:]],
+            ['What is a tort?', 'A civil wrong.', 'Give an example']
+        )
+    
+    def test_dry_run_leaves_replies_alone(self):
+        out = StringIO()
+        with mock.patch.object(batch_answer, 'PROVIDER_KIND', ProviderKind.OPENAI), \
+                mock.patch.object(batch_answer.HTTP_SESSION, 'post') as post:
+            call_command('batch_answer', '--dry-run', stdout=out)
+        
+        post.assert_not_called()
+        self.assertIn('Would re-answer 2 questions', out.getvalue())
+    
+    def test_interleaved_rows_without_session_are_skipped(self):
+        for role, content in [('user', 'Q-A'), ('user', 'Q-B'), ('assistant', 'ans-A'), ('assistant', 'ans-B')]:
+            Message.objects.create(session_id='', role=role, content=content)
+        
+        replies = [reply.session_id for _, reply in self.get_turns().values()]
+        self.assertEqual(replies, ['s1', 's1'])
+    
+    def test_unusable_results_are_counted(self):
+        pairs = self.get_turns()
+        question_id, (_, reply) = next(iter(pairs.items()))
+        output = b"\n".join([
+            orjson.dumps({"custom_id": question_id, "response": {"status_code": 200, "body": {
+                "choices": [{"message": {"content": "Fresh."}}]
+            }}}),
+            orjson.dumps({"custom_id": "unknown", "response": {"status_code": 200}}),
+            orjson.dumps({"custom_id": question_id, "response": {"status_code": 429}}),
+        ])
+        command = batch_answer.Command()
+        command.auth_headers = {}
+        with mock.patch.object(batch_answer.HTTP_SESSION, 'get', return_value=provider_response(200, output)):
+            replies, dropped = command.get_results('file-1', pairs)
+        
+        self.assertEqual([r.content for r in replies], ['Fresh.'])
+        self.assertEqual(dropped, 2)
+
+class SaveTurnTests(TestCase):
+    """save_turn validates, truncates and counts messages like a regular save()"""
+    
+    def setUp(self):
+        cache.clear()
+    
+    def test_turn_is_truncated_and_counted(self):
+        user_message, assistant_message = views.save_turn('s1', 'What is a tort?', 'x' * 6000)
+        
+        self.assertIsNotNone(assistant_message.id)
+        self.assertEqual(len(Message.objects.get(pk=assistant_message.pk).content), 5000)
+        self.assertEqual(cache.get('total_message_count'), 2)
+    
+    def test_backend_without_bulk_returning_saves_rows(self):
+        features = type(views.connections['default'].features)
+        with mock.patch.object(features, 'can_return_rows_from_bulk_insert', new_callable=mock.PropertyMock, return_value=False):
+            user_message, assistant_message = views.save_turn('s1', 'What is a tort?', 'A civil wrong.')
+        
+        self.assertEqual(Message.objects.filter(pk__in=[user_message.pk, assistant_message.pk]).count(), 2)
+        self.assertEqual(cache.get('total_message_count'), 2)
+    
+    def test_empty_reply_is_rejected(self):
+        with self.assertRaises(ValueError):
+            views.save_turn('s1', 'What is a tort?', ' ')
+        self.assertFalse(Message.objects.exists())
+
+class FakeSentenceTransformer:
+    """Embeds text by its word count, so questions of equal length match"""
+    
+    def __init__(self, name):
+        pass
+    
+    def encode(self, text, normalize_embeddings=True):
+        vector = numpy.zeros(8)
+        vector[len(text.split()) % 8] = 1.0
+        return vector
+
+@skipUnless(numpy, "numpy is not installed")
+@override_settings(SEMANTIC_CACHE_ENABLED=True, SEMANTIC_CACHE_TTL=60)
+class SemanticCacheTests(TestCase):
+    """Similar questions are answered from the in-process index until their rows expire"""
+    
+    def setUp(self):
+        module = mock.Mock(SentenceTransformer=FakeSentenceTransformer)
+        for patcher in (
+            mock.patch.dict(sys.modules, {'sentence_transformers': module}),
+            mock.patch.object(semantic_cache, '_model', None),
+            mock.patch.object(semantic_cache, '_index', OrderedDict()),
+            mock.patch.object(semantic_cache, '_next_prune', 0.0),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def test_lookup_reads_the_index_not_the_table(self):
+        semantic_cache.lookup('what is law', [])
+        semantic_cache.store('what is law', [], 'Rules.')
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(semantic_cache.lookup('what is tort', []), 'Rules.')
+        self.assertIsNone(semantic_cache.lookup('what is a tort', []))
+    
+    def test_expired_replies_are_ignored_and_pruned(self):
+        semantic_cache.store('what is law', [], 'Rules.')
+        CachedResponse.objects.update(created_at=timezone.now() - timedelta(seconds=120))
+        
+        self.assertIsNone(semantic_cache.lookup('what is tort', []))
+        semantic_cache._next_prune = 0.0
+        semantic_cache.store('a new question here', [], 'Fresh.')
+        self.assertEqual(list(CachedResponse.objects.values_list('response', flat=True)), ['Fresh.'])
+
+class InflightCoalescingTests(ProviderTestCase):
+    """Identical prompts arriving together make one provider call, whatever its outcome"""
+    
+    def ask_twice(self, result):
+        calls = []
+        
+        def fetch(messages_for_gpt):
+            calls.append(messages_for_gpt)
+            time.sleep(0.3)
+            return result
+        
+        responses = []
+        with mock.patch.object(views, 'fetch_ai_response', side_effect=fetch):
+            threads = [
+                threading.Thread(target=lambda: responses.append(views.get_ai_response_external_only('What is a tort?')))
+                for _ in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return calls, responses
+    
+    def test_identical_prompts_share_one_call(self):
+        calls, responses = self.ask_twice({'success': True, 'response': 'A civil wrong.'})
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r['response'] for r in responses], ['A civil wrong.'] * 2)
+    
+    def test_failure_is_shared_instead_of_retried(self):
+        failure = {'success': False, 'error': 'OpenAI rate limit exceeded.', 'error_type': 'rate_limit'}
+        calls, responses = self.ask_twice(failure)
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(responses, [failure, failure])
+
+class FasterAdminPaginatorTests(TestCase):
+    """The planner estimate only replaces COUNT(*) when it is too large to fit on one page"""
+    
+    def count_with_estimate(self, reltuples):
+        Message.objects.create(session_id='s1', role='user', content='What is a tort?')
+        postgres = mock.MagicMock(vendor='postgresql')
+        postgres.cursor.return_value.__enter__.return_value.fetchone.return_value = (reltuples,)
+        with mock.patch.object(message_admin, 'connections', {'default': postgres}):
+            return message_admin.FasterAdminPaginator(Message.objects.all(), 25).count
+    
+    def test_small_estimate_is_counted_exactly(self):
+        self.assertEqual(self.count_with_estimate(20), 1)
+    
+    def test_large_estimate_is_used(self):
+        self.assertEqual(self.count_with_estimate(2_000_000), 2_000_000)
+
+class ExportMessagesTests(TestCase):
+    """Oversized admin exports point at a command that reproduces their period"""
+    
+    def setUp(self):
+        old = timezone.now() - timedelta(days=10)
+        for i, role in enumerate(['user', 'assistant', 'user']):
+            message = Message.objects.create(session_id='s1', role=role, content=f'message {i}')
+            Message.objects.filter(pk=message.pk).update(created_at=old + timedelta(days=i))
+    
+    def test_large_selection_suggests_the_matching_command(self):
+        request = mock.Mock()
+        queryset = Message.objects.filter(role='user')
+        with mock.patch.object(message_admin, 'INLINE_EXPORT_LIMIT', 1), \
+                mock.patch.object(message_admin.messages, 'warning') as warning:
+            response = message_admin.MessageAdmin(Message, message_admin.admin.site).export_messages(request, queryset)
+        
+        self.assertIsNone(response)
+        text = warning.call_args.args[1]
+        self.assertIn('nothing was exported', text)
+        self.assertIn('--role user', text)
+        self.assertIn(f"--since {queryset.earliest('created_at').created_at.isoformat()}", text)
+    
+    def test_command_exports_only_the_period(self):
+        first, second, _ = Message.objects.order_by('created_at')
+        output = StringIO()
+        with mock.patch('builtins.open', mock.mock_open()) as opened:
+            call_command(
+                'export_messages', 'out.csv',
+                '--since', first.created_at.isoformat(), '--until', second.created_at.isoformat(),
+                stdout=output
+            )
+        
+        self.assertIn('Exported 2 messages', output.getvalue())
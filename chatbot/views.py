@@ -1,9 +1,13 @@
-import os, requests
+import os, orjson, requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.shortcuts import render, redirect
 from .models import Message
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections, router, transaction
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from rest_framework.decorators import api_view, permission_classes
@@ -17,51 +21,253 @@ from .serializers import (
     ChatResponseSerializer, 
     ErrorResponseSerializer
 )
-from .signals import conversation_started, conversation_ended, error_occurred
-import json
+from . import semantic_cache
+from .pagination import MessagePagination
+from .signals import (
+    conversation_started, conversation_ended, bump, count_new_message, prepare_message, record_error
+)
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import enum
+import hashlib
+import logging
+import threading
+import time
+import unicodedata
+
 
+logger = logging.getLogger(__name__)
 
 OPENAI_API_KEY = settings.OPENAI_API_KEY
 
+class ProviderKind(enum.Enum):
+    """Which provider the configured API key belongs to"""
+    NONE = 'none'
+    OPENAI = 'openai'
+    OPENROUTER = 'openrouter'
+
+# The key prefix identifies the provider, so it is resolved once at import
+if not OPENAI_API_KEY:
+    PROVIDER_KIND = ProviderKind.NONE
+elif OPENAI_API_KEY.startswith('sk-or-'):
+    PROVIDER_KIND = ProviderKind.OPENROUTER
+else:
+    PROVIDER_KIND = ProviderKind.OPENAI
+
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": (
+        "You are a legal assistant. Provide general legal information, "
+        "but always say: 'This is not legal advice.'"
+    ),
+}
+
+# Provider request headers, built once from the configured key
+OPENAI_HEADERS = {}
+if OPENAI_API_KEY:
+    OPENAI_HEADERS = {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+# Chat completion providers; every call goes through call_provider
+PROVIDERS = (
+    {
+        "kind": ProviderKind.OPENAI,
+        "label": "OpenAI",
+        "url": "https://api.openai.com/v1/chat/completions",
+        "model": "gpt-3.5-turbo",
+        "headers": OPENAI_HEADERS,
+    },
+    {
+        "kind": ProviderKind.OPENROUTER,
+        "label": "OpenRouter",
+        "url": "https://openrouter.ai/api/v1/chat/completions",
+        "model": "gpt-4o-mini",
+        "headers": {
+            **OPENAI_HEADERS,
+            "HTTP-Referer": "http://localhost:9000",
+            "X-Title": "LawBot"
+        },
+    },
+)
+
+# Error type and message for each failed provider response status
+STATUS_HANDLERS = {
+    401: ('auth_error', "Invalid {label} API key. Please check your API key configuration."),
+    429: ('rate_limit', "{label} rate limit exceeded. Please try again later."),
+}
+DEFAULT_STATUS_HANDLER = ('api_error', "{label} API Error (Status {status}): {body}")
+
+# A 401 from the provider the key belongs to fails the same way for every
+# model, so it is remembered (per process and in the shared cache) instead of
+# being retried
+AUTH_FAILURE_TTL = 300
+AUTH_FAILURE_CACHE_KEY = f"auth_failed_{hashlib.sha256((OPENAI_API_KEY or '').encode()).hexdigest()[:16]}"
+_AUTH_FAILED_UNTIL = 0.0
+
+# Provider the key belongs to, tried first on every request
+PRIMARY_PROVIDER = next((cfg for cfg in PROVIDERS if cfg["kind"] is PROVIDER_KIND), None)
+PROVIDER_MODEL = PRIMARY_PROVIDER["model"] if PRIMARY_PROVIDER else None
+
+# OpenAI models tried in turn when the primary provider fails; an OpenRouter
+# key is always refused by api.openai.com, so it gets no alternatives
+def build_alternative_providers(kind):
+    """Fallback provider configs for a key of the given kind"""
+    if kind is not ProviderKind.OPENAI:
+        return ()
+    # The primary's own model is left out; retrying it would repeat (and
+    # double-bill) the very request being raced
+    return tuple(
+        {**PROVIDERS[0], "model": model}
+        for model in ("gpt-3.5-turbo", "gpt-4", "gpt-4-turbo-preview")
+        if model != PROVIDERS[0]["model"]
+    )
+
+ALTERNATIVE_PROVIDERS = build_alternative_providers(PROVIDER_KIND)
+
+# Number of prior turns sent to the model with each request
+CONTEXT_TURNS = 20
+
+# Number of past messages rendered on the chat page
+CHAT_HISTORY_LIMIT = 50
+
+# Pooled keep-alive connections to the AI providers, shared by all requests.
+# Completions are billed once the request is sent, so a POST is only retried
+# when it never reached the provider (connect errors) or the gateway answered
+# 502/503/504; read timeouts and dropped responses surface unchanged
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    # Every provider worker, plus the request threads streaming replies, may
+    # hold a connection to the same host at once
+    pool_maxsize=settings.PROVIDER_POOL_SIZE + settings.PROVIDER_STREAM_CONNECTIONS,
+    max_retries=Retry(
+        total=2,
+        connect=2,
+        read=False,
+        other=0,
+        status=2,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({'POST'}),
+        raise_on_status=False
+    )
+))
+
+# Seconds to wait on a (non-streamed) chat completion
+PROVIDER_TIMEOUT = 30
+
+# Latencies of recent successful primary calls; their p95 becomes the head
+# start once there are enough of them
+primary_latencies = deque(maxlen=200)
+MIN_LATENCY_SAMPLES = 20
+
+provider_pool = ThreadPoolExecutor(max_workers=settings.PROVIDER_POOL_SIZE, thread_name_prefix='ai-provider')
+
+# Hedged duplicates only run while a slot is free; otherwise the primary is
+# simply waited on
+hedge_slots = threading.BoundedSemaphore(settings.PROVIDER_MAX_HEDGES)
+
+# Single writer, so background saves stay in order
+persistence_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='message-writer')
+
+# Replies are sampled at temperature 0.2, so cached ones are kept only briefly
+RESPONSE_CACHE_TTL = 900
+
+# Lifetime of the lock held by the request calling the API for an in-flight
+# prompt, and how long identical requests wait on it before calling themselves
+INFLIGHT_TIMEOUT = 60
+INFLIGHT_WAIT = 30
+INFLIGHT_POLL_INTERVAL = 0.1
+
+# How long a failed in-flight call's error is handed to the requests that waited on it
+INFLIGHT_FAILURE_TTL = 5
+
 class MessageViewSet(viewsets.ModelViewSet):
     """ViewSet for Message model with full CRUD operations"""
-    queryset = Message.objects.all().order_by('created_at')
+    queryset = Message.objects.only('id', 'role', 'content', 'created_at')
     serializer_class = MessageSerializer
     permission_classes = [AllowAny]
+    pagination_class = MessagePagination
     
     def get_queryset(self):
         """Filter messages by role if specified"""
-        queryset = Message.objects.all().order_by('created_at')
+        queryset = self.queryset.all()
         role = self.request.query_params.get('role', None)
         if role is not None:
             queryset = queryset.filter(role=role)
         return queryset
 
+def get_session_id(request, session_id=''):
+    """Conversation id for an API call: the one the caller sent, else its session cookie's key"""
+    # Never creates a session; a client without either simply has no context
+    return session_id or request.session.session_key or ''
+
+def get_browser_session_id(request):
+    """Conversation id for the web chat page, creating the browser session if needed"""
+    if not request.session.session_key:
+        request.session.create()
+    return request.session.session_key
+
+def save_turn(session_id, user_input, reply):
+    """Persist a user message and the assistant reply with a single INSERT"""
+    turn = [
+        Message(role="user", content=user_input, session_id=session_id),
+        Message(role="assistant", content=reply, session_id=session_id),
+    ]
+    
+    db = router.db_for_write(Message)
+    if not connections[db].features.can_return_rows_from_bulk_insert:
+        # Callers need the ids, which this backend can't return from a bulk INSERT
+        with transaction.atomic(using=db):
+            for message in turn:
+                message.save(using=db)
+        return turn
+    
+    # bulk_create() skips model signals, so run what the Message handlers do directly
+    for message in turn:
+        prepare_message(message)
+    Message.objects.bulk_create(turn)
+    for message in turn:
+        count_new_message(message)
+    
+    return turn
+
+def save_turn_in_background(session_id, user_input, reply):
+    """Queue save_turn() on the background writer when the caller doesn't need the saved rows"""
+    def write():
+        try:
+            save_turn(session_id, user_input, reply)
+        except Exception:
+            logger.exception("Failed to save chat turn for session %s", session_id)
+        finally:
+            connection.close()
+    
+    persistence_pool.submit(write)
+
 def chat_view(request):
     """Main chat view for the web interface"""
     if request.method == "POST":
         user_input = request.POST.get("message", "").strip()
         if user_input:
-            # Save user message
-            user_message = Message.objects.create(role="user", content=user_input)
+            session_id = get_browser_session_id(request)
 
             # Check if API key is configured
-            if not OPENAI_API_KEY:
+            if PROVIDER_KIND is ProviderKind.NONE:
                 error_msg = "OpenAI API key is not configured. Please set the OPENAI_API_KEY environment variable."
-                Message.objects.create(role="assistant", content=error_msg)
                 if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                    save_turn_in_background(session_id, user_input, error_msg)
                     return JsonResponse({'error': error_msg})
+                save_turn(session_id, user_input, error_msg)
                 return redirect("chat")
 
             # Get AI response with external APIs only
-            ai_response = get_ai_response_external_only(user_input)
+            ai_response = get_ai_response_external_only(user_input, session_id)
             
             if ai_response.get('success'):
-                # Save assistant message
-                assistant_message = Message.objects.create(
-                    role="assistant", 
-                    content=ai_response['response']
-                )
+                # Save the user message and assistant reply together
+                user_message, assistant_message = save_turn(session_id, user_input, ai_response['response'])
                 
                 if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                     return JsonResponse({
@@ -69,23 +275,27 @@ def chat_view(request):
                         'message_id': assistant_message.id
                     })
             else:
-                # Save error message
-                error_message = Message.objects.create(
-                    role="assistant", 
-                    content=ai_response['error']
-                )
-                
+                # Save the user message and error message together
                 if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                    save_turn_in_background(session_id, user_input, ai_response['error'])
                     return JsonResponse({
                         'error': ai_response['error'],
                         'error_type': ai_response.get('error_type', 'api_error')
                     })
+                save_turn(session_id, user_input, ai_response['error'])
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return JsonResponse({'error': 'No message provided'})
         return redirect("chat")
 
-    messages = Message.objects.all().order_by('created_at')
+    # Show the latest turns of this browser's conversation; the session is
+    # created here so the page's API calls carry it as a cookie
+    messages = list(
+        Message.objects.filter(session_id=get_browser_session_id(request)).order_by(
+            '-created_at', '-id'
+        )[:CHAT_HISTORY_LIMIT]
+    )
+    messages.reverse()
     return render(request, "index.html", {"messages": messages})
 
 def api_docs_view(request):
@@ -106,27 +316,24 @@ def chat_api(request):
         return Response(error_serializer.data, status=status.HTTP_400_BAD_REQUEST)
     
     user_input = serializer.validated_data['message']
+    conversation_started.send(sender=chat_api, user_message=user_input)
     
     # Check if API key is configured
-    if not OPENAI_API_KEY:
+    if PROVIDER_KIND is ProviderKind.NONE:
         error_serializer = ErrorResponseSerializer({
             'error': 'OpenAI API key is not configured. Please set the OPENAI_API_KEY environment variable.',
             'error_type': 'configuration_error'
         })
         return Response(error_serializer.data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
-    # Save user message
-    user_message = Message.objects.create(role="user", content=user_input)
+    session_id = get_session_id(request, serializer.validated_data.get('session_id', ''))
     
     # Get AI response with external APIs only
-    ai_response = get_ai_response_external_only(user_input)
+    ai_response = get_ai_response_external_only(user_input, session_id)
     
     if ai_response.get('success'):
-        # Save assistant message
-        assistant_message = Message.objects.create(
-            role="assistant", 
-            content=ai_response['response']
-        )
+        # Save the user message and assistant reply together
+        user_message, assistant_message = save_turn(session_id, user_input, ai_response['response'])
         
         # Return success response
         response_serializer = ChatResponseSerializer({
@@ -135,11 +342,9 @@ def chat_api(request):
         })
         return Response(response_serializer.data, status=status.HTTP_200_OK)
     else:
-        # Save error message
-        error_message = Message.objects.create(
-            role="assistant", 
-            content=ai_response['error']
-        )
+        # Save the user message and error message together; nothing in the
+        # response depends on the write, so it happens off the request path
+        save_turn_in_background(session_id, user_input, ai_response['error'])
         
         # Return error response
         error_serializer = ErrorResponseSerializer({
@@ -148,253 +353,420 @@ def chat_api(request):
         })
         return Response(error_serializer.data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def chat_stream_api(request):
+    """REST API endpoint for chat that streams the reply as server-sent events"""
+    serializer = ChatRequestSerializer(data=request.data)
+    if not serializer.is_valid():
+        error_serializer = ErrorResponseSerializer({
+            'error': 'Invalid request data',
+            'error_type': 'validation_error'
+        })
+        return Response(error_serializer.data, status=status.HTTP_400_BAD_REQUEST)
+    
+    user_input = serializer.validated_data['message']
+    conversation_started.send(sender=chat_stream_api, user_message=user_input)
+    
+    # Check if API key is configured
+    if PROVIDER_KIND is ProviderKind.NONE:
+        error_serializer = ErrorResponseSerializer({
+            'error': 'OpenAI API key is not configured. Please set the OPENAI_API_KEY environment variable.',
+            'error_type': 'configuration_error'
+        })
+        return Response(error_serializer.data, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+    session_id = get_session_id(request, serializer.validated_data.get('session_id', ''))
+    response = StreamingHttpResponse(
+        stream_chat_events(user_input, session_id),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # don't let a proxy buffer the stream
+    return response
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def messages_api(request):
-    """REST API endpoint to get all messages"""
-    messages = Message.objects.all().order_by('created_at')
-    serializer = MessageSerializer(messages, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    """REST API endpoint to get all messages, one page at a time"""
+    paginator = MessagePagination()
+    messages = Message.objects.only('id', 'role', 'content', 'created_at')
+    page = paginator.paginate_queryset(messages, request)
+    serializer = MessageSerializer(page, many=True)
+    return paginator.get_paginated_response(serializer.data)
+
+def build_context(session_id, k=CONTEXT_TURNS):
+    """Build the prompt from the system prompt and the last k turns of a session"""
+    if not session_id:
+        return [SYSTEM_PROMPT]
+    recent = list(
+        Message.objects.filter(session_id=session_id).order_by(
+            '-created_at', '-id'
+        ).values_list('role', 'content')[:k]
+    )
+    recent.reverse()
+    return [SYSTEM_PROMPT, *({"role": role, "content": content} for role, content in recent)]
+
+def normalize(text):
+    """Canonical form of a question for cache lookups; the API still gets the original"""
+    return unicodedata.normalize("NFKC", text).strip().casefold()
 
-def get_ai_response_external_only(user_input):
-    """Get AI response using only external APIs"""
+def response_cache_key(model, messages_for_gpt, temperature=0.2):
+    """Exact-match cache key for a chat completion request"""
+    *context, question = messages_for_gpt
+    payload = orjson.dumps({
+        "model": model,
+        "messages": [*context, {**question, "content": normalize(question["content"])}],
+        "temperature": temperature
+    }, option=orjson.OPT_SORT_KEYS)
+    return f"ai_response_{hashlib.sha256(payload).hexdigest()}"
+
+def build_messages(user_input, session_id):
+    """Prompt for a new turn; the turn itself is only persisted once the reply is in"""
+    return [*build_context(session_id), {"role": "user", "content": user_input}]
+
+def get_cached_reply(user_input, messages_for_gpt):
+    """Look up a reply in the exact-match cache, then the semantic cache"""
+    cached_reply = cache.get(response_cache_key(PROVIDER_MODEL, messages_for_gpt))
+    if cached_reply is not None:
+        bump('response_cache_hits')
+        return cached_reply
+    bump('response_cache_misses')
     
-    # Try OpenAI API first
-    if OPENAI_API_KEY and not OPENAI_API_KEY.startswith('sk-or-'):
-        response = try_openai_api(user_input)
-        if response.get('success'):
-            return response
+    # Fall back to a reply for a similar question asked in the same context
+    similar_reply = semantic_cache.lookup(normalize(user_input), messages_for_gpt[1:-1])
+    if similar_reply is not None:
+        bump('semantic_cache_hits')
+    return similar_reply
+
+def cache_reply(user_input, messages_for_gpt, reply):
+    """Store a fresh reply in both response caches"""
+    cache.set(response_cache_key(PROVIDER_MODEL, messages_for_gpt), reply, RESPONSE_CACHE_TTL)
+    if settings.SEMANTIC_CACHE_ENABLED:
+        store_similar_reply_in_background(normalize(user_input), messages_for_gpt[1:-1], reply)
+
+def store_similar_reply_in_background(question, context, reply):
+    """Embed and store a reply for the semantic cache on the background writer"""
+    def write():
+        try:
+            semantic_cache.store(question, context, reply)
+        except Exception:
+            logger.exception("Failed to store reply in the semantic cache")
+        finally:
+            connection.close()
     
-    # Try OpenRouter API second
-    if OPENAI_API_KEY and OPENAI_API_KEY.startswith('sk-or-'):
-        response = try_openrouter_api(user_input)
-        if response.get('success'):
+    persistence_pool.submit(write)
+
+def inflight_result(cache_key, failure_key):
+    """Reply or published failure of an identical request that already finished, if any"""
+    results = cache.get_many([cache_key, failure_key])
+    if cache_key in results:
+        return {'success': True, 'response': results[cache_key]}
+    return results.get(failure_key)
+
+def wait_for_inflight_reply(cache_key, lock_key, failure_key, deadline):
+    """Poll for the result of an identical request already in flight
+    
+    None when the other request went away without one, or the deadline passed.
+    """
+    while time.monotonic() < deadline:
+        time.sleep(INFLIGHT_POLL_INTERVAL)
+        result = inflight_result(cache_key, failure_key)
+        if result is not None:
+            return result
+        if cache.get(lock_key) is None:
+            # The other request finished; it may have published its result just now
+            return inflight_result(cache_key, failure_key)
+    return None
+
+def get_ai_response_external_only(user_input, session_id=''):
+    """Get AI response using only external APIs, reusing cached replies to identical requests"""
+    messages_for_gpt = build_messages(user_input, session_id)
+    
+    cached_reply = get_cached_reply(user_input, messages_for_gpt)
+    if cached_reply is not None:
+        return {'success': True, 'response': cached_reply}
+    
+    # Identical requests arriving together share one API call: the first takes
+    # the lock, the rest wait for its reply to land in the response cache (or
+    # for its error, which is kept briefly so they don't all retry at once)
+    cache_key = response_cache_key(PROVIDER_MODEL, messages_for_gpt)
+    lock_key = f"inflight_{cache_key}"
+    failure_key = f"inflight_failed_{cache_key}"
+    deadline = time.monotonic() + INFLIGHT_WAIT
+    is_leader = cache.add(lock_key, True, INFLIGHT_TIMEOUT)
+    while not is_leader and time.monotonic() < deadline:
+        response = wait_for_inflight_reply(cache_key, lock_key, failure_key, deadline)
+        if response is not None:
+            bump('inflight_coalesced')
             return response
+        # The other request left without a result; only one waiter takes over
+        is_leader = cache.add(lock_key, True, INFLIGHT_TIMEOUT)
+    if is_leader:
+        # An earlier call's error must not be handed to this call's waiters
+        cache.delete(failure_key)
     
-    # Try alternative OpenAI models
-    if OPENAI_API_KEY:
-        response = try_alternative_openai_api(user_input)
+    try:
+        response = fetch_ai_response(messages_for_gpt)
         if response.get('success'):
-            return response
+            cache_reply(user_input, messages_for_gpt, response['response'])
+        elif is_leader:
+            cache.set(failure_key, response, INFLIGHT_FAILURE_TTL)
+    finally:
+        if is_leader:
+            cache.delete(lock_key)
+    return response
+
+class ProviderRefused(Exception):
+    """The provider answered a streaming request with an error status"""
+    
+    def __init__(self, response):
+        super().__init__(response['error'])
+        self.response = response
+
+def stream_provider_reply(messages_for_gpt):
+    """Yield reply text from the primary provider as it is generated"""
+    payload = {
+        "model": PRIMARY_PROVIDER["model"],
+        "messages": messages_for_gpt,
+        "max_tokens": 500,
+        "temperature": 0.2,
+        "stream": True
+    }
+    
+    with HTTP_SESSION.post(
+        PRIMARY_PROVIDER["url"],
+        headers=PRIMARY_PROVIDER["headers"],
+        data=orjson.dumps(payload),
+        stream=True,
+        timeout=(5, 60)
+    ) as resp:
+        if resp.status_code != 200:
+            raise ProviderRefused(provider_status_error(PRIMARY_PROVIDER, resp))
+        for line in resp.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            data = line[6:]
+            if data == b"[DONE]":
+                break
+            chunk = orjson.loads(data)["choices"][0]["delta"].get("content")
+            if chunk:
+                yield chunk
+
+def sse_event(event, data):
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+def stream_chat_events(user_input, session_id):
+    """Server-sent events for one chat turn: deltas, then done (or error)"""
+    messages_for_gpt = build_messages(user_input, session_id)
+    reply = get_cached_reply(user_input, messages_for_gpt)
+    
+    if reply is not None:
+        yield sse_event('delta', {'content': reply})
+    else:
+        chunks = []
+        failure = None
+        try:
+            if api_key_rejected():
+                failure = rejected_key_response()
+            else:
+                for chunk in stream_provider_reply(messages_for_gpt):
+                    chunks.append(chunk)
+                    yield sse_event('delta', {'content': chunk})
+        except ProviderRefused as e:
+            failure = e.response
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError) as e:
+            if chunks:
+                # Part of the reply is already on screen, so it can't be swapped for a fallback
+                error_msg = f"The response was interrupted: {str(e)}"
+                save_turn(session_id, user_input, error_msg)
+                yield sse_event('error', {'error': error_msg, 'error_type': 'network_error'})
+                return
+            failure = {
+                'success': False,
+                'error': f"{PRIMARY_PROVIDER['label']} API network error: {str(e)}",
+                'error_type': 'network_error'
+            }
+        
+        if chunks:
+            reply = ''.join(chunks)
+        else:
+            # Nothing was streamed. The primary has had its turn, so only the
+            # alternatives are tried; a rate limit or a rejected key would
+            # fail the same way there and is reported as is
+            response = failure or {
+                'success': False,
+                'error': f"{PRIMARY_PROVIDER['label']} API returned an empty reply",
+                'error_type': 'api_error'
+            }
+            if response['error_type'] not in NO_FALLBACK_ERRORS and FALLBACK_CHAIN:
+                response = fetch_ai_response(messages_for_gpt, FALLBACK_CHAIN)
+            if not response.get('success'):
+                save_turn(session_id, user_input, response['error'])
+                yield sse_event('error', {
+                    'error': response['error'],
+                    'error_type': response.get('error_type', 'api_error')
+                })
+                return
+            reply = response['response']
+            yield sse_event('delta', {'content': reply})
+        
+        cache_reply(user_input, messages_for_gpt, reply)
+    
+    user_message, assistant_message = save_turn(session_id, user_input, reply)
+    yield sse_event('done', {'message_id': assistant_message.id})
+
+def mark_api_key_rejected():
+    """Remember that the providers rejected the configured key"""
+    global _AUTH_FAILED_UNTIL
+    _AUTH_FAILED_UNTIL = time.monotonic() + AUTH_FAILURE_TTL
+    cache.set(AUTH_FAILURE_CACHE_KEY, True, AUTH_FAILURE_TTL)
+
+def api_key_rejected():
+    """Whether the configured key was rejected within the last AUTH_FAILURE_TTL seconds"""
+    return time.monotonic() < _AUTH_FAILED_UNTIL or cache.get(AUTH_FAILURE_CACHE_KEY, False)
+
+def rejected_key_response():
+    """Configuration error returned while the key is known to be rejected"""
+    return {
+        'success': False,
+        'error': "The AI provider rejected the configured API key. Please check your API key configuration.",
+        'error_type': 'configuration_error'
+    }
+
+def provider_head_start():
+    """Seconds to give the primary before hedging: observed p95, or the configured default"""
+    samples = sorted(primary_latencies)
+    if len(samples) < MIN_LATENCY_SAMPLES:
+        return settings.PROVIDER_HEAD_START
+    return samples[int(len(samples) * 0.95) - 1]
+
+def release_hedge_slot(future):
+    """Free the hedge slot held by a finished (or cancelled) hedged call"""
+    hedge_slots.release()
+
+def fetch_ai_response(messages_for_gpt, chain=None):
+    """Call the external APIs, racing the fallback once the primary has had a head start"""
+    if api_key_rejected():
+        return rejected_key_response()
+    
+    candidates = list(PROVIDER_CHAIN if chain is None else chain)
+    head_start = provider_head_start()
+    
+    # Start the next candidate as soon as the running ones fail, or after the
+    # head start elapses if a hedge slot is free; the first success wins and
+    # stragglers that haven't started yet are cancelled
+    pending = set()
+    try:
+        while candidates or pending:
+            if candidates and (not pending or hedge_slots.acquire(blocking=False)):
+                future = provider_pool.submit(candidates.pop(0), messages_for_gpt)
+                if pending:
+                    future.add_done_callback(release_hedge_slot)
+                pending.add(future)
+            done, pending = wait(
+                pending,
+                timeout=head_start if candidates else None,
+                return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                response = future.result()
+                if response.get('success'):
+                    return response
+                if api_key_rejected():
+                    # The other candidates use the same key; don't start them
+                    candidates.clear()
+    finally:
+        for future in pending:
+            future.cancel()
+    
+    if api_key_rejected():
+        return rejected_key_response()
     
     # All external APIs failed
     error_msg = "All external AI services are currently unavailable. Please check your API key configuration or try again later."
-    error_occurred.send(
-        sender=get_ai_response_external_only,
-        error_type='all_apis_failed',
-        error_message=error_msg
-    )
+    record_error('all_apis_failed', error_msg)
     return {
         'success': False, 
         'error': error_msg,
         'error_type': 'all_apis_failed'
     }
 
-def try_openai_api(user_input):
-    """Try OpenAI API"""
-    try:
-        # Build conversation
-        messages_for_gpt = [{"role": m.role, "content": m.content} for m in Message.objects.all()]
-
-        # Add system prompt
-        system_prompt = {
-            "role": "system",
-            "content": (
-                "You are a legal assistant. Provide general legal information, "
-                "but always say: 'This is not legal advice.'"
-            ),
-        }
-        messages_for_gpt.insert(0, system_prompt)
-
-        # Call OpenAI API
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "model": "gpt-3.5-turbo",
-            "messages": messages_for_gpt,
-            "max_tokens": 500,
-            "temperature": 0.2
-        }
-        
-        resp = requests.post(
-            "https://api.openai.com/v1/chat/completions", 
-            headers=headers, 
-            json=payload, 
-            timeout=30
-        )
-        
-        if resp.status_code == 200:
-            reply_text = resp.json()["choices"][0]["message"]["content"]
-            return {'success': True, 'response': reply_text}
-        elif resp.status_code == 401:
-            error_msg = "Invalid OpenAI API key. Please check your API key configuration."
-            error_occurred.send(
-                sender=try_openai_api,
-                error_type='auth_error',
-                error_message=error_msg
-            )
-            return {'success': False, 'error': error_msg, 'error_type': 'auth_error'}
-        elif resp.status_code == 429:
-            error_msg = "Rate limit exceeded. Please try again later."
-            error_occurred.send(
-                sender=try_openai_api,
-                error_type='rate_limit',
-                error_message=error_msg
-            )
-            return {'success': False, 'error': error_msg, 'error_type': 'rate_limit'}
-        else:
-            error_msg = f"OpenAI API Error (Status {resp.status_code}): {resp.text}"
-            error_occurred.send(
-                sender=try_openai_api,
-                error_type='api_error',
-                error_message=error_msg
-            )
-            return {'success': False, 'error': error_msg, 'error_type': 'api_error'}
-            
-    except requests.exceptions.Timeout:
-        error_msg = "OpenAI API request timed out. Please try again."
-        return {'success': False, 'error': error_msg, 'error_type': 'timeout'}
-    except requests.exceptions.RequestException as e:
-        error_msg = f"OpenAI API network error: {str(e)}"
-        return {'success': False, 'error': error_msg, 'error_type': 'network_error'}
-    except Exception as e:
-        error_msg = f"OpenAI API error: {str(e)}"
-        return {'success': False, 'error': error_msg, 'error_type': 'api_error'}
+def provider_status_error(provider_cfg, resp):
+    """Record and describe a failed provider response"""
+    if resp.status_code == 401 and provider_cfg["kind"] is PROVIDER_KIND:
+        mark_api_key_rejected()
+    
+    error_type, error_msg = STATUS_HANDLERS.get(resp.status_code, DEFAULT_STATUS_HANDLER)
+    error_msg = error_msg.format(label=provider_cfg["label"], status=resp.status_code, body=resp.text[:200])
+    record_error(error_type, error_msg)
+    return {'success': False, 'error': error_msg, 'error_type': error_type}
 
-def try_openrouter_api(user_input):
-    """Try OpenRouter API"""
+def call_provider(provider_cfg, messages_for_gpt):
+    """Request a chat completion from one provider"""
+    label = provider_cfg["label"]
     try:
-        # Build conversation
-        messages_for_gpt = [{"role": m.role, "content": m.content} for m in Message.objects.all()]
-
-        # Add system prompt
-        system_prompt = {
-            "role": "system",
-            "content": (
-                "You are a legal assistant. Provide general legal information, "
-                "but always say: 'This is not legal advice.'"
-            ),
-        }
-        messages_for_gpt.insert(0, system_prompt)
-
-        # Call OpenRouter API
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "http://localhost:9000",
-            "X-Title": "LawBot"
-        }
         payload = {
-            "model": "gpt-4o-mini",
+            "model": provider_cfg["model"],
             "messages": messages_for_gpt,
             "max_tokens": 500,
             "temperature": 0.2
         }
         
-        resp = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions", 
-            headers=headers, 
-            json=payload, 
-            timeout=30
+        resp = HTTP_SESSION.post(
+            provider_cfg["url"],
+            headers=provider_cfg["headers"],
+            data=orjson.dumps(payload),
+            timeout=PROVIDER_TIMEOUT
         )
         
         if resp.status_code == 200:
-            reply_text = resp.json()["choices"][0]["message"]["content"]
+            reply_text = orjson.loads(resp.content)["choices"][0]["message"]["content"]
             return {'success': True, 'response': reply_text}
-        elif resp.status_code == 401:
-            error_msg = "Invalid OpenRouter API key. Please check your API key configuration."
-            error_occurred.send(
-                sender=try_openrouter_api,
-                error_type='auth_error',
-                error_message=error_msg
-            )
-            return {'success': False, 'error': error_msg, 'error_type': 'auth_error'}
-        elif resp.status_code == 429:
-            error_msg = "OpenRouter rate limit exceeded. Please try again later."
-            error_occurred.send(
-                sender=try_openrouter_api,
-                error_type='rate_limit',
-                error_message=error_msg
-            )
-            return {'success': False, 'error': error_msg, 'error_type': 'rate_limit'}
-        else:
-            error_msg = f"OpenRouter API Error (Status {resp.status_code}): {resp.text}"
-            error_occurred.send(
-                sender=try_openrouter_api,
-                error_type='api_error',
-                error_message=error_msg
-            )
-            return {'success': False, 'error': error_msg, 'error_type': 'api_error'}
+        return provider_status_error(provider_cfg, resp)
             
     except requests.exceptions.Timeout:
-        error_msg = "OpenRouter API request timed out. Please try again."
+        error_msg = f"{label} API request timed out. Please try again."
         return {'success': False, 'error': error_msg, 'error_type': 'timeout'}
     except requests.exceptions.RequestException as e:
-        error_msg = f"OpenRouter API network error: {str(e)}"
+        error_msg = f"{label} API network error: {str(e)}"
         return {'success': False, 'error': error_msg, 'error_type': 'network_error'}
     except Exception as e:
-        error_msg = f"OpenRouter API error: {str(e)}"
+        error_msg = f"{label} API error: {str(e)}"
         return {'success': False, 'error': error_msg, 'error_type': 'api_error'}
 
-def try_alternative_openai_api(user_input):
+def try_primary_api(messages_for_gpt):
+    """Try the provider the API key belongs to, recording how long successful calls take"""
+    started = time.monotonic()
+    response = call_provider(PRIMARY_PROVIDER, messages_for_gpt)
+    if response.get('success'):
+        primary_latencies.append(time.monotonic() - started)
+    return response
+
+def try_alternative_openai_api(messages_for_gpt):
     """Try alternative OpenAI models"""
-    try:
-        # Build conversation
-        messages_for_gpt = [{"role": m.role, "content": m.content} for m in Message.objects.all()]
-
-        # Add system prompt
-        system_prompt = {
-            "role": "system",
-            "content": (
-                "You are a legal assistant. Provide general legal information, "
-                "but always say: 'This is not legal advice.'"
-            ),
-        }
-        messages_for_gpt.insert(0, system_prompt)
+    for provider_cfg in ALTERNATIVE_PROVIDERS:
+        response = call_provider(provider_cfg, messages_for_gpt)
+        if response.get('success') or api_key_rejected():
+            return response
+    return {'success': False, 'error': "All OpenAI models failed"}
 
-        # Try different models
-        models_to_try = ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo-preview"]
-        
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        for model in models_to_try:
-            try:
-                payload = {
-                    "model": model,
-                    "messages": messages_for_gpt,
-                    "max_tokens": 500,
-                    "temperature": 0.2
-                }
-                
-                resp = requests.post(
-                    "https://api.openai.com/v1/chat/completions", 
-                    headers=headers, 
-                    json=payload, 
-                    timeout=30
-                )
-                
-                if resp.status_code == 200:
-                    reply_text = resp.json()["choices"][0]["message"]["content"]
-                    return {'success': True, 'response': reply_text}
-                elif resp.status_code == 401:
-                    continue  # Try next model
-                elif resp.status_code == 429:
-                    continue  # Try next model
-                    
-            except Exception:
-                continue  # Try next model
-                
-        return {'success': False, 'error': "All OpenAI models failed"}
-        
-    except Exception as e:
-        return {'success': False, 'error': f"Alternative OpenAI Error: {str(e)}"}
+# Routing is resolved once at import: the primary provider first, then the
+# alternative OpenAI models
+PROVIDER_CHAIN = ()
+if PROVIDER_KIND is not ProviderKind.NONE:
+    PROVIDER_CHAIN = (try_primary_api,)
+if ALTERNATIVE_PROVIDERS:
+    PROVIDER_CHAIN += (try_alternative_openai_api,)
+
+# Candidates left once the primary has already failed (e.g. while streaming)
+FALLBACK_CHAIN = PROVIDER_CHAIN[1:]
+
+# Errors the alternatives, sharing the same key, would only repeat
+NO_FALLBACK_ERRORS = ('rate_limit', 'auth_error', 'configuration_error')
 
 # Keep the old function for backward compatibility
-def get_ai_response(user_input):
+def get_ai_response(user_input, session_id=''):
     """Legacy function - now uses external APIs only"""
-    return get_ai_response_external_only(user_input)
+    return get_ai_response_external_only(user_input, session_id)
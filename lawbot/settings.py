@@ -20,6 +20,21 @@ load_dotenv()
 # OpenAI API Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Provider hedging: seconds the primary runs alone before a fallback is raced
+# against it (until enough latencies are observed to use their p95), the
+# worker threads shared by all provider calls, and how many of those may be
+# busy with hedged duplicates at once
+PROVIDER_HEAD_START = float(os.getenv('PROVIDER_HEAD_START', '6'))
+PROVIDER_POOL_SIZE = int(os.getenv('PROVIDER_POOL_SIZE', '32'))
+PROVIDER_MAX_HEDGES = int(os.getenv('PROVIDER_MAX_HEDGES', '4'))
+# Pooled provider connections kept for streaming replies, on top of the workers'
+PROVIDER_STREAM_CONNECTIONS = int(os.getenv('PROVIDER_STREAM_CONNECTIONS', '16'))
+
+# Reuse replies to similar questions (requires sentence-transformers)
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'False').lower() == 'true'
+# Seconds a cached reply may be reused before it is pruned
+SEMANTIC_CACHE_TTL = int(os.getenv('SEMANTIC_CACHE_TTL', '86400'))
+
 # Cache Configuration
 CACHES = {
     'default': {
@@ -94,6 +109,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chatbot.middleware.RequestContextMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -111,6 +127,12 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'lawbot.urls'
 
+# Django REST Framework
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'chatbot.pagination.MessagePagination',
+    'PAGE_SIZE': 50,
+}
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 TEMPLATES = [